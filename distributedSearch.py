@@ -0,0 +1,149 @@
+import multiprocessing as mp
+import pickle
+import random
+import socket
+import struct
+import sys
+
+import dshieldPlanner # module import: dshieldPlanner imports this module too
+
+# Distributed root-parallel search: each remote worker searches its own independent tree (like the
+# non-shared parallelMCTS mode) and sends back the collectParallelResults() payload.
+# Messages are length-prefixed pickles over TCP, so workers must only listen on trusted networks.
+#
+# Coordinator -> worker, per search: {"type": "problem", "problem": bytes}, then
+#   {"type": "search", "seed", "randomChoicePct", "rolloutLimit", "timeLimit", "keepTrees", "initialTree"}
+# Worker -> coordinator: {"type": "result", "result": treeResults} or {"type": "error", "message": str}
+# {"type": "close"} ends the session, {"type": "shutdown"} stops the worker.
+
+
+def sendMsg(sock, msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack("<Q", len(data)) + data)
+
+
+def recvMsg(sock):
+    size = struct.unpack("<Q", recvExactly(sock, 8))[0]
+    return pickle.loads(recvExactly(sock, size))
+
+
+def recvExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        assert chunk, "recvExactly() ERROR! connection closed"
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def parseAddress(address):
+    # "host:port" or (host, port)
+    if isinstance(address, str):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return tuple(address)
+
+
+def packProblem(applicationMethod, settings):
+    # serialize the application instance (the problem) with the planner settings, which refer to its methods.
+    # The application's planner holds locks and Manager proxies, so it is detached while pickling.
+    app = applicationMethod.__self__
+    planner = app.planner
+    app.planner = None
+    try:
+        return pickle.dumps((app, settings, applicationMethod.__name__), pickle.HIGHEST_PROTOCOL)
+    finally:
+        app.planner = planner
+
+
+class DistributedWorker:
+    # Search server for one core: runs one in-process search at a time for a coordinator
+    # (run one worker per core of each machine)
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def bind(self):
+        # port 0 picks a free port; self.port is the bound port
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        return self.host, self.port
+
+    def serve(self):
+        if not self.server:
+            self.bind()
+        print("DistributedWorker.serve() listening on "+self.host+":"+str(self.port))
+        done = False
+        while not done:
+            conn, _ = self.server.accept()
+            with conn:
+                done = self.handleSession(conn)
+        self.server.close()
+        print("DistributedWorker.serve() exit")
+
+    def handleSession(self, conn):
+        # returns True when the worker should stop
+        problem = None
+        while True:
+            msg = recvMsg(conn)
+            if msg["type"] == "problem":
+                problem = pickle.loads(msg["problem"])
+            elif msg["type"] == "search":
+                try:
+                    assert problem, "handleSession() ERROR! search before problem"
+                    sendMsg(conn, {"type": "result", "result": self.search(problem, msg)})
+                except Exception as e:
+                    sendMsg(conn, {"type": "error", "message": repr(e)})
+            else:
+                return msg["type"] == "shutdown"
+
+    def search(self, problem, msg):
+        app, settings, methodName = problem
+        settings = dict(settings, inProcess=True, processCount=1, workers=None, rolloutLimit=msg["rolloutLimit"], timeLimit=msg["timeLimit"])
+        if "logBackend" not in settings or settings["logBackend"] == "queue":
+            settings["logBackend"] = "stdout"
+        planner = dshieldPlanner.DshieldPlanner(settings)
+        planner.keepTrees = msg["keepTrees"]
+        planner.initialTrees = [msg["initialTree"]] if msg["initialTree"] else None
+        app.planner = planner
+        random.seed(msg["seed"]) # after DshieldPlanner(), which seeds with its default seed
+        planner.inProcessMCTS(getattr(app, methodName), msg["randomChoicePct"])
+        return planner.parallelResults[0]
+
+
+def startLocalWorkers(count, host="127.0.0.1"):
+    # local stand-in for a cluster: count worker processes on localhost ports
+    # returns (["host:port"], processes)
+    addresses = []
+    procs = []
+    for i in range(count):
+        worker = DistributedWorker(host)
+        host, port = worker.bind()
+        proc = mp.Process(target=worker.serve)
+        proc.start()
+        worker.server.close() # the worker process has its own copy of the listening socket
+        addresses.append(host+":"+str(port))
+        procs.append(proc)
+    return addresses, procs
+
+
+def stopWorkers(addresses):
+    for address in addresses:
+        with socket.create_connection(parseAddress(address)) as sock:
+            sendMsg(sock, {"type": "shutdown"})
+
+
+def main():
+    # python distributedSearch.py [host] [port]: run one worker
+    host = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    DistributedWorker(host, port).serve()
+
+if __name__ == '__main__':
+    main()
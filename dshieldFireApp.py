@@ -1,15 +1,34 @@
 import copy
 import math
+import pickle
 import time
 import matplotlib.pyplot as plt
 
+from array import array
 from collections import OrderedDict
 
 from dshieldPlanner import DshieldPlanner
 from fileUtil import *
+from varAgenda import VarAgenda
 
 import multiprocessing as mp
 
+# Command kinds (cmdKinds) and the ids of the commands shared by every var
+IDL = 0
+RAW = 1
+DNL = 2
+GAP = 3 # no command possible, written as "***"
+CMD_NAMES = ("IDL", "RAW", "DNL", "***")
+IDL_CMD = 0
+GAP_CMD = 1
+
+def iterBits(bits):
+    # indexes of the set bits of an int bitset, lowest first
+    while bits:
+        lowBit = bits & -bits
+        yield lowBit.bit_length() - 1
+        bits ^= lowBit
+
 class DshieldFireApp:
     def __init__(self):
     
@@ -19,11 +38,20 @@ class DshieldFireApp:
         self.experimentRun = "RUN001"
         self.planHorizonStart = 0
         self.planHorizonDuration = 24 * 3600 # seconds
+        self.planWindowDuration = None # seconds, receding-horizon planning over windows of this length when set
+        self.planCommitDuration = 2 * 3600 # seconds of each window's best plan committed before the window advances
+        self.lazyGpPropagation = False # True: strip observed GPs from a var's RAW choice when the var is popped, instead of from every var covering them after each observation
         # self.satList = ["CYG41884"]
         self.satList = ["CYG41884", "CYG41885", "CYG41886", "CYG41887"]#, "CYG41888"]#, "CYG41889", "CYG41890", "CYG41891"]
         self.powerModelName = "model1"
         self.storageParams = {"capacity": 5772, "collectionRatePerSec": 96.2172, "downlinkRatePerSec": 4} # megabits
-        self.plannerParams = {"objective": self.updatePlanScore,  "rolloutLimit": 40000, "processCount": 10, "greedy": False, "allGreedy": False, "planHorizon": str(self.planHorizonDuration/3600)+" hrs"}
+        self.plannerParams = {"objective": self.updatePlanScore,  "rolloutLimit": 40000, "timeLimit": None, "processCount": 10, "greedy": False, "allGreedy": False, "planHorizon": str(self.planHorizonDuration/3600)+" hrs",
+                              "snapshot": self.saveSnapshot, "snapshotCacheMB": 64, "snapshotMinVisits": 4,
+                              "profile": "development", # "production": no per-rollout tracing
+                              "inProcess": False, # True: search in this process, without worker processes (processCount is ignored)
+                              "stallRollouts": 0, "stallSeconds": 0, # stop early when the best score stops improving (0: run to the limit)
+                              "stateHash": self.stateHash, "transpositionTableSize": 0, # entries, 0 disables the transposition table
+                              "moveText": self.cmdText} # planner log shows cmd ids as plan file text
 
         # Internal initialization
 
@@ -41,25 +69,56 @@ class DshieldFireApp:
         self.powerModel = None
         self.allPlanVars = {}  # includes every second (for logging only)
         self.initialPlanVars = [] # created once, filtered to remove all vars with a single choice (IDL or ***)
-        self.planVars = {} # copied from initialPlanVars on each rollout
-        self.planVarKeysSorted = []
+        # Each rollout starts from the initial agenda and domains, built once by buildInitialAgenda(), and only
+        # writes the domains it prunes (copy-on-write)
+        self.initialAgenda = None # open vars at the start of a rollout, reset on each rollout
+        self.initialDomains = {} # {varId: choices} at the start of a rollout
+        self.planVars = {} # {varId: choices} pruned in this rollout, other open vars have their initialDomains
+        self.varAgenda = VarAgenda([], [], 0) # open vars in planning order
         # self.planVarTerms = {}
-        self.gpVars = {} # Maps each GP to the variables with cmd choices which cover the GP
+        self.gpVars = [] # gpIndex -> the vars with RAW choices which cover the GP
+        # Vars and commands are ints in the planning loop, built by createPlanVars(); names are only made for output
+        self.varNames = [] # varId -> "sat.tick"
+        self.varSat = array("h") # varId -> index in satList
+        self.varTick = array("i") # varId -> tick
+        self.satIndexes = {} # sat -> index in satList
+        self.cmdKinds = array("b") # cmdId -> IDL, RAW, DNL or GAP
+        # GP sets are int bitsets over dense GP indexes (in GP id order), so strip and overlap tests are word-parallel
+        self.gpIndexes = {} # GP id -> gpIndex
+        self.gpIds = [] # gpIndex -> GP id
+        self.gpValues = array("d") # gpIndex -> target value
+        self.cmdGps = [] # cmdId -> bitset of the GPs observed by a RAW cmd
+        self.cmdParams = [] # cmdId -> parameter text of a DNL cmd
+        self.varGps = {} # {varId: bitset of the GPs not observed yet}, for the RAW choices which lost GPs in this rollout
+        self.observedGps = 0 # bitset of the GPs observed by any sat in this rollout (lazyGpPropagation)
         self.state = {} # dynamically updated by updateState()
+        self.energyHashBucket = 100 # Joules, energy resolution of stateHash()
+        self.committedPlan = {} # {varId: cmdId} committed by earlier receding-horizon windows
+        self.windowSnapshot = None # pickled state after the committed plan, each rollout of the current window starts from it
 
         self.planner = DshieldPlanner(self.plannerParams)
         self.bestPlan = {}
         self.fileMgr = FileUtil(self)
 
+    def __getstate__(self):
+        # pickled for distributed workers: initialAgenda is rebuilt on first use, since pickled agendas
+        # are not tracked and its removals of the last rollout could not be undone
+        state = self.__dict__.copy()
+        state["initialAgenda"] = None
+        return state
+
     def run(self):
         print("\nDshieldFirePlanner.run() satellites: "+str(len(self.satList)))
         print("   data storage model: "+str(self.storageParams))
         self.fileMgr.readInputs()
         self.initPowerModel()
-        self.createPlanVars()
+        if self.planWindowDuration:
+            self.planRecedingHorizon()
+        else:
+            self.createPlanVars()
 
-        # init planner
-        self.planner.start(self.createConstellationPlan)
+            # init planner
+            self.planner.start(self.createConstellationPlan)
         self.extractBestPlan()
         self.fileMgr.writeResultFiles()
         self.simulateAndVerifyPlan()
@@ -68,93 +127,188 @@ class DshieldFireApp:
             self.fileMgr.writeImageInfo(sat, satState["images"])
         print("Fire Planner Done")
 
-    def createConstellationPlan(self):
-        # Top-level application code, simulated on each MCTS rollout
-        self.planner.logMsg("createConstellationPlan()")
+    def planRecedingHorizon(self):
+        # Plan over [windowStart, windowStart + planWindowDuration], commit the first planCommitDuration seconds
+        # of the best plan and advance the window. The planner keeps the subtree below the committed moves
+        # so each window's search starts from the statistics gathered by the previous one.
+        horizonEnd = self.planHorizonStart + self.planHorizonDuration
+        windowStart = self.planHorizonStart
+        self.committedPlan = {}
+        self.planner.keepTrees = True
+        while True:
+            windowEnd = min(windowStart + self.planWindowDuration, horizonEnd)
+            print("\nplanRecedingHorizon() window: "+str(windowStart)+" - "+str(windowEnd)+", committed vars: "+str(len(self.committedPlan)))
+            self.createPlanVars(windowEnd)
+            self.applyCommittedPlan(windowStart)
+            self.planner.start(self.createConstellationPlan)
+            if windowEnd >= horizonEnd:
+                break
+            commitEnd = windowStart + self.planCommitDuration
+            self.commitPlanSegment(windowStart, commitEnd)
+            self.planner.advanceRoot(self.committedPlan)
+            windowStart = commitEnd
+        self.planner.keepTrees = False
+        self.planner.initialTrees = None
+        self.windowSnapshot = None
+
+    def commitPlanSegment(self, startTick, endTick):
+        # commit the best plan's commands for vars in [startTick, endTick)
+        bestPlanState = self.planner.bestPlanState
+        for sat in self.satList:
+            for varId, cmdId in bestPlanState[sat]["plan"]:
+                if startTick <= self.varTick[varId] < endTick:
+                    self.committedPlan[varId] = cmdId
+
+    def applyCommittedPlan(self, endTick):
+        # apply the committed commands of every var before endTick once, so each rollout of the window
+        # restores the resulting state instead of re-deciding those vars
+        self.windowSnapshot = None
+        if not self.committedPlan:
+            return
         self.initializeState()
         self.initializePlanVars()
-        while self.planVarKeysSorted:
-            varName = self.planVarKeysSorted[0]
-            varChoices = self.popPlanVar(varName)
-            choiceDict = {"varName": varName, "choices": varChoices}
+        while self.varAgenda:
+            varId = self.varAgenda.first()
+            if self.varTick[varId] >= endTick:
+                break
+            varChoices = self.popPlanVar(varId)
+            if self.lazyGpPropagation:
+                varChoices = self.removeObservedGpFromVar(varId, varChoices)
+                if len(varChoices) < 2:
+                    continue # only IDL left
+            choiceDict = self.forceDownlinkIfStorageNotEmpty({"varName": varId, "choices": varChoices})
+            assert varId in self.committedPlan, "applyCommittedPlan() ERROR! no committed cmd for var: "+self.varNames[varId]
+            cmdId = self.committedPlan[varId]
+            assert cmdId in choiceDict["choices"], "applyCommittedPlan() ERROR! committed cmd "+self.cmdText(cmdId)+" not in choices of var: "+self.varNames[varId]
+            self.updateState(varId, cmdId)
+            self.propagateChoice(varId, cmdId)
+        self.windowSnapshot = pickle.dumps(self.saveSnapshot(), pickle.HIGHEST_PROTOCOL)
+
+    def createConstellationPlan(self):
+        # Top-level application code, simulated on each MCTS rollout
+        if self.planner.traceRollouts:
+            self.planner.logMsg("createConstellationPlan()")
+        snapshot = self.planner.getResumeSnapshot()
+        if snapshot:
+            self.restoreSnapshot(snapshot) # resume after the deepest cached move of this rollout's replay plan
+        elif self.windowSnapshot:
+            self.restoreSnapshot(pickle.loads(self.windowSnapshot)) # receding horizon: start after the committed plan
+        else:
+            self.initializeState()
+            self.initializePlanVars()
+        while self.varAgenda:
+            varId = self.varAgenda.first()
+            varChoices = self.popPlanVar(varId)
+            if self.lazyGpPropagation:
+                varChoices = self.removeObservedGpFromVar(varId, varChoices)
+                if len(varChoices) < 2:
+                    continue # only IDL left
+            choiceDict = {"varName": varId, "choices": varChoices}
             choiceDict = self.forceDownlinkIfStorageNotEmpty(choiceDict)
             # call MCTS for choice point
             # TODO: why do we pass varname to chooseValue?
             if self.greedy or self.allGreedy:
-                cmd = self.planner.chooseValue(choiceDict, self.sortChoicesByCmdScore)  # TODO: ps sat or varName to localHeuristic
+                cmdId = self.planner.chooseValue(choiceDict, self.sortChoicesByCmdScore)  # TODO: ps sat or varName to localHeuristic
             else:
-                cmd = self.planner.chooseValue(choiceDict, "random")     #TODO: ps sat or varName to localHeuristic
+                cmdId = self.planner.chooseValue(choiceDict, "random")     #TODO: ps sat or varName to localHeuristic
 
-            self.updateState(varName, cmd)
-            self.propagateChoice(varName, cmd)
-        self.planner.logMsg("createConstellationPlan() done")
+            self.updateState(varId, cmdId)
+            self.propagateChoice(varId, cmdId)
+            self.planner.choiceApplied()
+        if self.planner.traceRollouts:
+            self.planner.logMsg("createConstellationPlan() done")
+
+    def saveSnapshot(self):
+        # planner snapshot cache: everything createConstellationPlan() needs to continue from the current choice point
+        return (self.state, self.planVars, self.varAgenda, self.varGps, self.observedGps)
+
+    def restoreSnapshot(self, snapshot):
+        self.state, self.planVars, self.varAgenda, self.varGps, self.observedGps = snapshot
+
+    def stateHash(self):
+        # planner transposition table key: next var, and per sat its last planned var, storage, energy bucket,
+        # set of observed GPs and total downlinked fraction
+        key = [self.varAgenda.first()]
+        for sat in self.satList:
+            satState = self.state[sat]
+            lastVar = satState["plan"][-1][0] if satState["plan"] else None
+            images = satState["images"].values()
+            downlinked = round(sum(imageInfo["downlinkPct"] for imageInfo in images), 3)
+            key.append((lastVar, satState["storageUsed"], int(satState["energy"] // self.energyHashBucket), satState["observedGps"], downlinked))
+        return hash(tuple(key))
 
     def initializePlanVars(self):
-        # called on each rollout
-        self.planVarKeysSorted = []
-        varPairs = []
-        for varName, choices in self.initialPlanVars:
-            self.planVars[varName] = choices
-            _, tp = varName.split(".")
-            varPairs.append((varName, int(tp)))
-        sortedPairs = sorted(varPairs, key=lambda x: x[1])
-        for v in sortedPairs:
-            self.planVarKeysSorted.append(v[0])
-
-        self.removeInitialInfeasibleChoices() # remove invalid choices (after populating planVarKeysSorted)
-
-        # initialize planVarTerms and gpVars if necessary (first time initializePlanVars is called only)
-        # if not self.planVarTerms and not self.gpVars:
+        # called on each rollout, after initializeState()
+        if self.initialAgenda is None:
+            self.buildInitialAgenda()
+        self.initialAgenda.reset() # undo the removals of the last rollout which started from it
+        self.varAgenda = self.initialAgenda
+        self.planVars = {}
+        self.varGps = {}
+        self.observedGps = 0
+
+        # initialize gpVars if necessary (first time initializePlanVars is called only)
         if not self.gpVars:
-            for varName in self.planVarKeysSorted:
-                # sat, tick = varName.split(".")
-                # self.planVarTerms[varName] = (sat, int(tick))
-                cmd, choices = self.planVars[varName]
-                if cmd.startswith("RAW"):
-                    cmdName, gpList = cmd.split(".")
-                    gpList = [int(x) for x in gpList.split(",")]
-                    for gp in gpList:
-                        if gp in self.gpVars:
-                            self.gpVars[gp].append(varName)
-                        else:
-                            self.gpVars[gp] = [varName]
+            self.gpVars = [[] for gpIndex in self.gpIds]
+            for varId in self.varAgenda:
+                cmdId = self.getVarChoices(varId)[0]
+                if self.cmdKinds[cmdId] == RAW:
+                    for gpIndex in iterBits(self.cmdGps[cmdId]):
+                        self.gpVars[gpIndex].append(varId)
+
+    def buildInitialAgenda(self):
+        # the agenda and domains every rollout starts from: initialPlanVars sorted by tick (stable, so vars of the
+        # same tick stay in satList order), less the choices infeasible in the initial state
+        self.initialDomains = dict(self.initialPlanVars)
+        self.planVars = {}
+        sortedVars = sorted(self.initialDomains, key=self.varTick.__getitem__)
+        self.varAgenda = VarAgenda(sortedVars, self.varSat, len(self.satList))
+        self.removeInitialInfeasibleChoices()
+        self.initialDomains.update(self.planVars)
+        self.initialAgenda = self.varAgenda
+        self.initialAgenda.track()
+
+    def getVarChoices(self, varId):
+        return self.planVars[varId] if varId in self.planVars else self.initialDomains[varId]
 
     def forceDownlinkIfStorageNotEmpty(self, choiceDict):
-        sat,tick = choiceDict["varName"].split(".")
-        if self.isStorageEmpty(sat):
+        if self.isStorageEmpty(self.getVarSat(choiceDict["varName"])):
             return choiceDict
         varChoices = choiceDict["choices"]
         isDownlinkOpportunity = False
         for choice in varChoices:
-            if choice.startswith("DNL."):
+            if self.cmdKinds[choice] == DNL:
                 isDownlinkOpportunity = True
                 break
         if isDownlinkOpportunity:
-            assert 'IDL' in varChoices, "forceDownlinkIfStorageNotEmpty() ERROR! IDLE missing from var choices: "+str(choiceDict)
+            assert IDL_CMD in varChoices, "forceDownlinkIfStorageNotEmpty() ERROR! IDLE missing from var choices: "+str(choiceDict)
             filteredChoices = copy.copy(varChoices)
-            filteredChoices.remove('IDL')
+            filteredChoices.remove(IDL_CMD)
             choiceDict["choices"] = filteredChoices
         return choiceDict
 
 
-    def propagateChoice(self, varName, cmd):
-        sat, tick = varName.split(".")
+    def propagateChoice(self, varId, cmdId):
         # TODO: handle low power case
         # if self.isLowPower():
         #   self.removeAllChoices() # remove choices until power > min
-        self.removeInfeasibleChoices(sat, cmd)
-        self.removeObservedGpFromChoices(cmd, varName)
-
-    def removeInfeasibleChoices(self, sat, cmd):
-        # assumes planVarKeysSorted has already been created
-        if cmd.startswith("RAW") and self.isStorageFull(sat):
+        self.removeInfeasibleChoices(self.getVarSat(varId), cmdId)
+        if not self.lazyGpPropagation:
+            self.removeObservedGpFromChoices(cmdId, varId)
+        elif self.cmdKinds[cmdId] == RAW:
+            self.observedGps |= self.getRawGps(varId, cmdId)
+
+    def removeInfeasibleChoices(self, sat, cmdId):
+        # assumes varAgenda has already been created
+        kind = self.cmdKinds[cmdId]
+        if kind == RAW and self.isStorageFull(sat):
             self.removeObservationChoices(sat)
-        elif cmd.startswith("DNL") and self.isStorageEmpty(sat):
+        elif kind == DNL and self.isStorageEmpty(sat):
             self.removeDownlinkChoices(sat)
 
 
     def removeInitialInfeasibleChoices(self):
-        # assumes planVarKeysSorted has already been created
+        # assumes varAgenda has already been created
         for sat in self.satList:
             if self.isStorageFull(sat):
                 self.removeObservationChoices(sat)
@@ -165,104 +319,136 @@ class DshieldFireApp:
         # Removes observation choices until next DNL opportunity, because storage is full
         # Removes variables with less than 2 choices
         # Assumes storage is full (checked by caller)
+        satIndex = self.satIndexes[sat]
+        cmdKinds = self.cmdKinds
         isDownlinkAvailable = False
         varsToRemove = []
-        for varName in self.planVarKeysSorted:
-            if varName.startswith(sat):
-                choices = self.planVars[varName]
-                filteredChoices = []
-                for choice in choices:
-                    if choice.startswith("DNL"):
-                        isDownlinkAvailable = True
-                    if isDownlinkAvailable or not choice.startswith("RAW"):
-                        filteredChoices.append(choice)
-                if len(filteredChoices) > 1:
-                    self.planVars[varName] = filteredChoices
+        for varId in self.varAgenda.satVars(satIndex):
+            choices = self.getVarChoices(varId)
+            filteredChoices = []
+            for choice in choices:
+                if cmdKinds[choice] == DNL:
+                    isDownlinkAvailable = True
+                if isDownlinkAvailable or cmdKinds[choice] != RAW:
+                    filteredChoices.append(choice)
+            if len(filteredChoices) > 1:
+                self.planVars[varId] = filteredChoices
+            else:
+                if filteredChoices[0] == IDL_CMD:
+                    varsToRemove.append(varId)
                 else:
-                    if filteredChoices[0] == 'IDL':
-                        varsToRemove.append(varName)
-                    else:
-                        print("removeObservationChoices() ERROR! Removing non idle choice: "+str(varName)+", choice: "+str(filteredChoices))
-                if isDownlinkAvailable:
-                    break # exit loop for varName in self.planVars.keys()
+                    print("removeObservationChoices() ERROR! Removing non idle choice: "+self.varNames[varId]+", choice: "+str([self.cmdText(c) for c in filteredChoices]))
+            if isDownlinkAvailable:
+                break # exit loop over the sat's vars
 
-        for varName in varsToRemove:
-            self.popPlanVar(varName)
+        for varId in varsToRemove:
+            self.popPlanVar(varId)
 
     def removeDownlinkChoices(self, sat):
         # Removes downlink choices until next observation opportunity, because storage is empty
         # Removes variables with less than 2 choices
         # Assumes storage is empty (checked by caller)
+        satIndex = self.satIndexes[sat]
+        cmdKinds = self.cmdKinds
         isTargetAvailable = False
         varsToRemove = []
-        for varName in self.planVarKeysSorted: #self.planVars.keys():
-            if varName.startswith(sat):
-                choices = self.planVars[varName]
-                filteredChoices = []
-                for choice in choices:
-                    if choice.startswith("RAW"):
-                        isTargetAvailable = True
-                    if isTargetAvailable or not choice.startswith("DNL"):
-                        filteredChoices.append(choice)
-                if len(filteredChoices) > 1:
-                    self.planVars[varName] = filteredChoices
+        for varId in self.varAgenda.satVars(satIndex):
+            choices = self.getVarChoices(varId)
+            filteredChoices = []
+            for choice in choices:
+                if cmdKinds[choice] == RAW and (not self.lazyGpPropagation or self.getRawGps(varId, choice) & ~self.observedGps):
+                    isTargetAvailable = True
+                if isTargetAvailable or cmdKinds[choice] != DNL:
+                    filteredChoices.append(choice)
+            if len(filteredChoices) > 1:
+                self.planVars[varId] = filteredChoices
+            else:
+                if filteredChoices[0] == IDL_CMD:
+                    varsToRemove.append(varId)
                 else:
-                    if filteredChoices[0] == 'IDL':
-                        varsToRemove.append(varName)
-                    else:
-                        print("removeDownlinkChoices() ERROR! Removing non idle choice: "+str(varName)+", choice: "+str(filteredChoices))
-                if isTargetAvailable:
-                    break # exit loop for varName in self.planVars.keys()
-        for varName in varsToRemove:
-            self.popPlanVar(varName)
-
-
-    def removeObservedGpFromChoices(self, cmd, varName):
-        if cmd.startswith("RAW"):
-            cmdName, params = cmd.split(".")
-            observedGpText = params.split(",")
-            observedGpList = [int(gp) for gp in observedGpText]
+                    print("removeDownlinkChoices() ERROR! Removing non idle choice: "+self.varNames[varId]+", choice: "+str([self.cmdText(c) for c in filteredChoices]))
+            if isTargetAvailable:
+                break # exit loop over the sat's vars
+        for varId in varsToRemove:
+            self.popPlanVar(varId)
+
+
+    def removeObservedGpFromChoices(self, cmdId, varId):
+        if self.cmdKinds[cmdId] == RAW:
+            observedGps = self.getRawGps(varId, cmdId)
+            otherVars = set()
+            for gpIndex in iterBits(observedGps):
+                otherVars.update(self.gpVars[gpIndex])
+            otherVars.discard(varId)
             varsToRemove = []
-            for gp in observedGpList:
-                vars = self.gpVars[gp]
-                for otherVarName in vars:
-                    if otherVarName != varName and otherVarName in self.planVars:
-                        varChoices = self.planVars[otherVarName]
-                        newChoices = []
-                        for otherCmd in varChoices:
-                            newCmd = None
-                            if otherCmd.startswith("RAW"):
-                                newCmd = self.stripObservedGps(otherCmd, observedGpText)
-                            else:
-                                newCmd = otherCmd
-                            if newCmd:
-                                newChoices.append(newCmd)
-                        # replace planVar's choices
-                        if len(newChoices) > 1:
-                            self.planVars[otherVarName] = newChoices  #destructive change in self.planVars
-                        else:
-                            # remove vars with less than two choices
-                            if otherVarName not in varsToRemove:
-                                varsToRemove.append(otherVarName)
-            # end for gp in observedGpList
-            if varsToRemove:
-                # print("removing "+str(len(planVarsToRemove))+ " vars")
-                for v in varsToRemove:
-                    self.popPlanVar(v)
-
-    def stripObservedGps(self, cmd, observedGps):
-        # strip observedGPs from cmd
-        # return no gps remain then return None
-        newCmd = cmd
-        for g in observedGps:
-            if g in cmd:
-                newCmd = newCmd.replace(g, "").replace(".,",".").replace(",,",",")
-        if newCmd.endswith(","):
-            newCmd = newCmd[:-1]
-        if not newCmd.endswith("."):
-            return newCmd
-        else:
-            return None
+            for otherVarId in otherVars:
+                if otherVarId in self.varAgenda:
+                    varChoices = self.getVarChoices(otherVarId)
+                    newChoices = []
+                    for otherCmd in varChoices:
+                        if self.cmdKinds[otherCmd] != RAW or self.stripObservedGps(otherVarId, otherCmd, observedGps):
+                            newChoices.append(otherCmd)
+                    # replace planVar's choices
+                    if len(newChoices) > 1:
+                        self.planVars[otherVarId] = newChoices  #destructive change in self.planVars
+                    else:
+                        # remove vars with less than two choices
+                        varsToRemove.append(otherVarId)
+            for v in varsToRemove:
+                self.popPlanVar(v)
+
+    def removeObservedGpFromVar(self, varId, varChoices):
+        # lazyGpPropagation: the choices of a popped var, less a RAW choice whose GPs have all been observed
+        newChoices = []
+        for cmdId in varChoices:
+            if self.cmdKinds[cmdId] != RAW or self.stripObservedGps(varId, cmdId, self.observedGps):
+                newChoices.append(cmdId)
+        return newChoices
+
+    def stripObservedGps(self, varId, cmdId, observedGps):
+        # strip the observedGps bitset from the RAW choice cmdId of varId
+        # returns the bitset of the GPs which remain (0 when none remain)
+        gps = self.getRawGps(varId, cmdId)
+        remainingGps = gps & ~observedGps
+        if remainingGps != gps:
+            self.varGps[varId] = remainingGps
+        return remainingGps
+
+    def getRawGps(self, varId, cmdId):
+        # GPs a RAW choice would observe now: those of the cmd which earlier choices of this rollout did not observe
+        return self.varGps[varId] if varId in self.varGps else self.cmdGps[cmdId]
+
+    def getVarSat(self, varId):
+        return self.satList[self.varSat[varId]]
+
+    def getGpIds(self, gps):
+        # GP ids of a bitset, ascending
+        return [self.gpIds[gpIndex] for gpIndex in iterBits(gps)]
+
+    def getGpBits(self, gpIds):
+        gps = 0
+        for gp in gpIds:
+            gps |= 1 << self.gpIndexes[gp]
+        return gps
+
+    def cmdText(self, cmdId, gps=None):
+        # output only: the cmd as written in the plan files, e.g. "RAW.101,102" (gps: GP ids replacing the cmd's GPs), "DNL.3" or "IDL"
+        kind = self.cmdKinds[cmdId]
+        if kind == RAW:
+            return "RAW."+",".join(str(gp) for gp in (self.getGpIds(self.cmdGps[cmdId]) if gps is None else gps))
+        elif kind == DNL:
+            return "DNL."+self.cmdParams[cmdId]
+        return CMD_NAMES[kind]
+
+    def planText(self, plan, images):
+        # output only: [(varName, cmd)] of a sat's [(varId, cmdId)] plan. Each RAW step created one of the sat's images
+        # (in plan order) whose targets are the GPs it observed.
+        rawImages = iter(images.values())
+        steps = []
+        for varId, cmdId in plan:
+            gps = next(rawImages)["targets"] if self.cmdKinds[cmdId] == RAW else None
+            steps.append((self.varNames[varId], self.cmdText(cmdId, gps)))
+        return steps
 
     def readPlanVarsFromFile(self):
         self.initialPlanVars = self.fileMgr.readPlanVarsFile()
@@ -282,51 +468,82 @@ class DshieldFireApp:
         print("readPlanVars() var count: "+str(len(vars)))
         return vars
 
-    def createPlanVars(self):
+    def createPlanVars(self, endTick=None):
         print("createPlanVars()")
         # self.initialPlanVars = self.readPlanVars()
         # return
+        # Var and cmd ids cover the whole horizon, so they stay the same across receding-horizon windows
+        horizonEnd = self.planHorizonStart + self.planHorizonDuration
+        if endTick is None:
+            endTick = horizonEnd
+        self.allPlanVars = {}
+        self.initialPlanVars = []
+        self.gpVars = [] # rebuilt by the next initializePlanVars()
+        self.initialAgenda = None # rebuilt by the next initializePlanVars()
+        self.varNames = []
+        self.varSat = array("h")
+        self.varTick = array("i")
+        self.satIndexes = {sat: satIndex for satIndex, sat in enumerate(self.satList)}
+        self.cmdKinds = array("b", [IDL, GAP]) # IDL_CMD, GAP_CMD
+        self.gpIds = sorted(self.targetValues)
+        self.gpIndexes = {gp: gpIndex for gpIndex, gp in enumerate(self.gpIds)}
+        self.gpValues = array("d", [self.targetValues[gp] for gp in self.gpIds])
+        self.cmdGps = [0, 0]
+        self.cmdParams = ["", ""]
+        dnlCmds = {} # DNL param -> cmdId
         obsVarCount = 0
         dnlVarCount = 0
-        for sat in self.satList:
+        for satIndex, sat in enumerate(self.satList):
             choices = self.satChoices[sat]
             tpList = sorted(choices.keys())
             for tp in tpList:
-                if tp > self.planHorizonStart + self.planHorizonDuration:
+                if tp > horizonEnd:
                     break
-                varName = sat + "."+str(tp)
+                varId = len(self.varNames)
+                self.varNames.append(sat + "."+str(tp))
+                self.varSat.append(satIndex)
+                self.varTick.append(tp)
                 varDomain = choices[tp]
                 if list(varDomain.keys())[0] == "GAP":
-                    varDomain = "***"
+                    cmdId = GAP_CMD
                 elif "DNL" in varDomain:
-                    varDomain = "DNL."+str(varDomain["DNL"])
-                    varDomain = varDomain
-                    dnlVarCount += 1
+                    param = str(varDomain["DNL"])
+                    if param not in dnlCmds:
+                        dnlCmds[param] = self.addCmd(DNL, 0, param)
+                    cmdId = dnlCmds[param]
+                    if tp <= endTick:
+                        dnlVarCount += 1
                 else:
                     gpList = []
                     for sourceId in varDomain.keys():
                         gpList.extend(varDomain[sourceId])
-                    gpList = str(sorted(gpList)).replace(" ","").strip("[,]")
-                    varDomain = "RAW." + gpList
-                    obsVarCount += 1
-                varDomain = [varDomain]
-                if "***" not in varDomain:
-                    varDomain.append("IDL")
-                self.allPlanVars[varName] = varDomain
+                    cmdId = self.addCmd(RAW, self.getGpBits(gpList), "")
+                    if tp <= endTick:
+                        obsVarCount += 1
+                if tp > endTick:
+                    continue
+                varDomain = [cmdId]
+                if cmdId != GAP_CMD:
+                    varDomain.append(IDL_CMD)
+                self.allPlanVars[varId] = varDomain
                 if len(varDomain) > 1:
-                    self.initialPlanVars.append((varName, varDomain))
+                    self.initialPlanVars.append((varId, varDomain))
         self.fileMgr.writePlanVarFile(False) # all vars
         self.fileMgr.writePlanVarFile(True)  # filtered to remove vars with only a single choice (IDLE)
         print("createPlanVars() created "+str(len(self.initialPlanVars))+" vars")
         print("obsVarCount: "+str(obsVarCount)+", dnlVarCount: "+str(dnlVarCount))
 
-    def popPlanVar(self, varName):
-        # print("popPlanVar() "+varName)
-        assert varName in self.planVars, "popPlanVar() varName "+varName +  " not in planVars"
-        assert varName in self.planVarKeysSorted, "popPlanVar() varName "+varName +  " not in planVarKeysSorted"
-        poppedVarChoices = self.planVars.pop(varName)
-        self.planVarKeysSorted.remove(varName)
-        assert len(self.planVars) == len(self.planVarKeysSorted), "popPlanVar() mismatch! planVars : "+str(len(self.planVars))+ ", varKeys: "+str(len(self.planVarKeysSorted))
+    def addCmd(self, kind, gps, params):
+        # RAW cmds get one id per var (gps: the var's GP bitset), DNL cmds one id per param
+        self.cmdKinds.append(kind)
+        self.cmdGps.append(gps)
+        self.cmdParams.append(params)
+        return len(self.cmdKinds) - 1
+
+    def popPlanVar(self, varId):
+        assert varId in self.varAgenda, "popPlanVar() var "+self.varNames[varId] +  " not in varAgenda"
+        poppedVarChoices = self.planVars.pop(varId) if varId in self.planVars else self.initialDomains[varId]
+        self.varAgenda.remove(varId)
         return poppedVarChoices
 
 # STATE MANAGEMENT METHODS
@@ -335,23 +552,24 @@ class DshieldFireApp:
         # observedGP = orderedDict {GP : [targetValue, % downlinked], }
         # dynamic state
         for sat in self.satList:
-            self.state[sat] = {"storageUsed": 0, "energy": self.initialEnergy, "observedGP": OrderedDict(), "images": OrderedDict(), "plan": []}
+            self.state[sat] = {"storageUsed": 0, "energy": self.initialEnergy, "observedGP": OrderedDict(), "observedGps": 0, "images": OrderedDict(), "plan": []}
 
     def getSatState(self, sat):
         return self.state[sat]
 
-    def updateState(self, varName, cmd):
+    def updateState(self, varId, cmdId):
         # called by createConstellationPlan()
-        sat, tick = varName.split(".")
+        sat = self.getVarSat(varId)
         satState = self.getSatState(sat)
-        if cmd.startswith("RAW"):
+        kind = self.cmdKinds[cmdId]
+        if kind == RAW:
             self.incrementStorage(satState)
-            self.updateImages(cmd, satState)
-        elif cmd.startswith("DNL"):
+            self.updateImages(varId, cmdId, satState)
+        elif kind == DNL:
             self.decrementStorage(satState)
             self.updateDownlinkedImagePct(satState)
-        self.updateEnergyState(sat, tick, cmd)
-        satState["plan"].append((varName, cmd))
+        self.updateEnergyState(sat, self.varTick[varId], kind == DNL)
+        satState["plan"].append((varId, cmdId))
 
     def updateStateForVerification(self, sat,planStep, priorStep):
         # called by createConstellationPlan()
@@ -392,23 +610,21 @@ class DshieldFireApp:
         result = satState["storageUsed"]
         return result
 
-    def updateImages(self, cmd, satState):
-        cmdTerms = cmd.split(".")
-        params = cmdTerms[1].split(".")
-        gpList = params[0].split(",")
-        gpIntList = [int(gp) for gp in gpList]
-        self.extendImagesDict(satState, gpIntList)
+    def updateImages(self, varId, cmdId, satState):
+        self.extendImagesDict(satState, self.getRawGps(varId, cmdId))
 
     def updateImagesForVerification(self, satState, planStep):
         tick = planStep["tick"]
         targets = planStep["targets"]
-        self.extendImagesDict(satState, targets, tick)
+        self.extendImagesDict(satState, self.getGpBits(targets), tick)
 
-    def extendImagesDict(self, satState, newObservedGP, tick=None):
-        # imagesDict = {imageID: [sum(values of newObservedGP), % downlinked]}
-        imageValue = round(sum([self.targetValues[gp] for gp in newObservedGP]), 5)
+    def extendImagesDict(self, satState, newObservedGps, tick=None):
+        # newObservedGps: GP bitset
+        # imagesDict = {imageID: [sum(values of newObservedGps), % downlinked]}
+        imageValue = round(sum([self.gpValues[gpIndex] for gpIndex in iterBits(newObservedGps)]), 5)
         imageId = len(satState["images"])+1 # +1 so that image ID 0 is not mistaken for null
-        imageInfo = {"value": imageValue, "downlinkPct": 0.00, "targets": newObservedGP}
+        imageInfo = {"value": imageValue, "downlinkPct": 0.00, "targets": self.getGpIds(newObservedGps)}
+        satState["observedGps"] |= newObservedGps
         if tick:
             imageInfo.update({"start": tick}) # used for tracking latency (post-processing only)
         satState["images"][imageId] = imageInfo # [value, % downlinked]
@@ -464,19 +680,18 @@ class DshieldFireApp:
         self.initialEnergy = self.energyMax * (self.powerModel["initialChargePct"]/100) # Joules
         print("\ninitPowerModel() model: "+str(self.powerModel) +" initial: "+str(self.initialEnergy)+", min: "+str(self.energyMin)+", max: "+str(self.energyMax)+"\n")
 
-    def updateEnergyState(self, sat, tick, cmd):
-        tick = int(tick)
+    def updateEnergyState(self, sat, tick, isDownlink):
         priorTick = self.getPriorTimestepForSat(sat, tick)
-        self.updateEnergyStateDetails(sat, tick, cmd, priorTick)
+        self.updateEnergyStateDetails(sat, tick, isDownlink, priorTick)
 
     def updateEnergyStateForVerification(self, planStep, priorStep):
         sat = planStep["sat"]
         tick = planStep["tick"]
-        cmd = planStep["cmd"]
+        isDownlink = planStep["cmd"].startswith("DNL")
         priorTick = priorStep["tick"] if priorStep else -1
-        self.updateEnergyStateDetails(sat, tick, cmd, priorTick)
+        self.updateEnergyStateDetails(sat, tick, isDownlink, priorTick)
 
-    def updateEnergyStateDetails(self, sat, tick, cmd, priorTick):
+    def updateEnergyStateDetails(self, sat, tick, isDownlink, priorTick):
         # calculate energy level at the end of tick (after executing cmd)
         # energy values are in Joules
         satState = self.getSatState(sat)
@@ -490,7 +705,7 @@ class DshieldFireApp:
                     energyIn += self.powerModel["powerIn"]  # power is Watts  = Jules/second
             # Sensor is always on so add its consumption to the idle power consumption
             energyOut = self.powerModel["idlePowerOut"] + self.powerModel["sensorPowerOut"] # 1 second of power
-            if cmd.startswith("DNL"):
+            if isDownlink:
                 energyOut += self.powerModel["downlinkPowerOut"] # 1 second of power
         energyLevel = min(initialEnergy + energyIn, self.energyMax)  # never exceed energyMax
         if energyOut:
@@ -514,14 +729,12 @@ class DshieldFireApp:
         # TODO: do we need to check if otherVarSat == sat?
         satState = self.getSatState(sat)
         plan = satState["plan"]
+        satIndex = self.satIndexes[sat]
         index = -1
         while abs(index) <= len(plan):
             otherVar, otherCmd = plan[index]
-            otherVarSat, otherVarTick = otherVar.split(".")
-            otherVarTick = int(otherVarTick)
-            # otherVarSat, otherVarTick = self.planVarTerms[otherVar]
-            # otherVarTick = otherVarTick
-            if otherVarSat == sat and otherVarTick < tick:
+            otherVarTick = self.varTick[otherVar]
+            if self.varSat[otherVar] == satIndex and otherVarTick < tick:
                 return otherVarTick
             else:
                 index -= 1
@@ -557,12 +770,12 @@ class DshieldFireApp:
 
     def sortChoicesByCmdScore(self, choicesDict):
         # used by chooseValue()
-        varName = choicesDict["varName"]
+        varId = choicesDict["varName"]
         choices = choicesDict["choices"]
-        sat, tick = varName.split(".")
+        sat = self.getVarSat(varId)
         choicePairs = []
         for choice in choices:
-            cmdScore = self.getAggregateGpCmdScore(sat, choice)
+            cmdScore = self.getAggregateGpCmdScore(sat, varId, choice)
             choicePairs.append((cmdScore, choice))
         sortedPairs = sorted(choicePairs, key=lambda c: c[0], reverse=True)  # sort by cmdScore (descending)
         sortedChoices = []
@@ -570,25 +783,18 @@ class DshieldFireApp:
             sortedChoices.append(pair[1])
         return sortedChoices
 
-    def getAggregateGpCmdScore(self, sat, cmd):
+    def getAggregateGpCmdScore(self, sat, varId, cmdId):
         # local heuristic used by chooseValue()
         satState = self.getSatState(sat)
-        images = list(satState["images"].keys())
-        previouslyObservedGp = set()
-        for image in images:
-            gpList = satState["images"][image]["targets"]
-            previouslyObservedGp.update(gpList)
         totalScore = 0
-        if cmd.startswith("RAW"):
-            cmd, params = cmd.split(".")
-            gpList = params.split(",")
-            gpList = [int(gp) for gp in gpList]
-            for gp in gpList:
-                # don't count duplicate observations
-                if gp not in previouslyObservedGp:
-                    observationScore = self.targetValues[gp]/2 # half of reward for observation
-                    totalScore += observationScore
-        elif cmd.startswith("DNL"):
+        kind = self.cmdKinds[cmdId]
+        if kind == RAW:
+            # don't count duplicate observations
+            newGps = self.getRawGps(varId, cmdId) & ~satState["observedGps"]
+            for gpIndex in iterBits(newGps):
+                observationScore = self.gpValues[gpIndex]/2 # half of reward for observation
+                totalScore += observationScore
+        elif kind == DNL:
             downlinkImage = self.getCurrentDownlinkImage(satState)
             if downlinkImage:
                 imageInfo = satState["images"][downlinkImage]
@@ -629,12 +835,13 @@ class DshieldFireApp:
         planDict = {}
         for planVar, planVarChoices in filteredPlan:
             planDict[planVar] = planVarChoices
-        for varName in self.allPlanVars.keys():
-            if varName.startswith(sat):
-                if varName in planDict:
-                    fullPlan.append((varName, planDict[varName]))
+        satIndex = self.satIndexes[sat]
+        for varId in self.allPlanVars.keys():
+            if self.varSat[varId] == satIndex:
+                if varId in planDict:
+                    fullPlan.append((varId, planDict[varId]))
                 else:
-                    fullPlan.append((varName, "***"))
+                    fullPlan.append((varId, GAP_CMD))
         return fullPlan
 
     def simulateAndVerifyPlan(self):
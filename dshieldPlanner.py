@@ -1,4 +1,4 @@
-import copy
+import asyncio
 import inspect
 import os
 import signal
@@ -6,12 +6,26 @@ from datetime import datetime
 import math
 import time
 import random
+import threading
 import tracemalloc
 import psutil
 import multiprocessing as mp
+import socket
 
+import distributedSearch
+from array import array
+from logSink import LogSink, mergeLogs
 from mctsNode import MctsNode
+from mctsTree import MctsTree
+from rolloutStats import RolloutStats
+from sharedMctsTree import SharedMctsTree
+from snapshotCache import SnapshotCache
+from stageProfiler import StageProfiler, formatStageStats
 from supervisor import Supervisor
+from transpositionTable import TranspositionTable
+
+# Log levels: logMsg() messages are "info", per-rollout tracing is "debug"
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "off": 100}
 
 
 class DshieldPlanner:
@@ -22,38 +36,143 @@ class DshieldPlanner:
         self.settings = settings  # Example: {"objective": app.objectiveFn, "rolloutLimit": 10000, "timeLimit": 15}
         self.rolloutLimit = settings["rolloutLimit"] if "rolloutLimit" in settings else None
         self.processCount = settings["processCount"] if "processCount" in settings else 1
-        self.plannerTimeLimitSeconds = settings["timeLimit"] if "timeLimit" in settings else None
+        # In-process mode: one search run directly by start(), with plain local objects instead of the
+        # Manager, logger, Supervisor and worker processes (for small queries, scripts and processCount 1)
+        self.inProcess = settings["inProcess"] if "inProcess" in settings else False
+        if self.inProcess and self.processCount != 1:
+            print("DshieldPlanner() WARNING! inProcess runs a single search, ignoring processCount: "+str(self.processCount))
+            self.processCount = 1
+        self.plannerTimeLimitSeconds = settings["timeLimit"] if "timeLimit" in settings else None # wall-clock budget for parallelMCTS
+        if not (self.rolloutLimit or self.plannerTimeLimitSeconds):
+            raise ValueError("DshieldPlanner() ERROR! settings need a rolloutLimit or a timeLimit")
         self.randomSeed = 3
         self.useSharedNodes = False
+        self.sharedNodeBackend = settings["sharedNodeBackend"] if "sharedNodeBackend" in settings else "sharedMemory" # or "manager"
+        self.useManagerNodes = False # set by parallelMCTS()
+        # Tree-parallel search (sharedMemory backend): workers select, expand and backpropagate concurrently,
+        # using virtual loss and per-node locks instead of holding sharedNodesLock from select to expand
+        self.treeParallel = settings["treeParallel"] if "treeParallel" in settings else False
+        self.virtualLoss = settings["virtualLoss"] if "virtualLoss" in settings else 1 # visits added to each node on the selection path
+        self.useTreeParallel = False # set by parallelMCTS()
+        self.virtualLossPath = None # node ids given virtual loss by the current rollout
+        # Distributed root-parallel search: independent trees searched by DistributedWorker servers ("host:port" list)
+        # instead of local worker processes, see distributedMCTS()
+        self.workerAddresses = settings["workers"] if "workers" in settings and settings["workers"] else None
+        # Root statistics synchronization (independent trees): every rootSyncInterval rollouts each worker publishes
+        # the visits and rewards of its root and the nodes rootSyncDepth moves below it, and adds the other workers'
+        # statistics for the same nodes to its own when selecting (0 disables)
+        self.rootSyncInterval = settings["rootSyncInterval"] if "rootSyncInterval" in settings else 0
+        self.rootSyncDepth = settings["rootSyncDepth"] if "rootSyncDepth" in settings else 1
+        self.rootStatsDict = None # {worker pid: shallowNodeStats()}, created by parallelMCTS()
+        self.rootSyncCount = 0
+        # Early stopping on convergence (checked every convergenceCheckInterval rollouts, 0 disables a criterion):
+        # no improvement of the best score of all workers in stallRollouts rollouts or stallSeconds seconds, or a root
+        # visit distribution whose shares changed by less than rootStabilityThreshold in rootStabilityChecks checks in a row.
+        # With several workers the search stops only once every worker has converged (see isConverged)
+        self.stallRollouts = settings["stallRollouts"] if "stallRollouts" in settings else 0
+        self.stallSeconds = settings["stallSeconds"] if "stallSeconds" in settings else 0
+        self.rootStabilityThreshold = settings["rootStabilityThreshold"] if "rootStabilityThreshold" in settings else 0
+        self.rootStabilityChecks = settings["rootStabilityChecks"] if "rootStabilityChecks" in settings else 3
+        self.convergenceCheckInterval = settings["convergenceCheckInterval"] if "convergenceCheckInterval" in settings else 100
+        self.checkConvergence = bool(self.stallRollouts or self.stallSeconds or self.rootStabilityThreshold)
+        self.convergedVotes = None # one flag per parallelMCTS worker, created by parallelMCTS()
+        self.workerIndex = 0 # set by parallelMCTS() before forking each worker
         self.sharedNodes = None
         self.sharedNodesLock = None
+        self.holdingNodesLock = False # sharedNodesLock is held from select until expand (without tree parallelism)
+        # Logging: the "production" profile turns off per-rollout tracing whatever the logLevel
+        self.profile = settings["profile"] if "profile" in settings else "development"
+        defaultLogLevel = "info" if self.profile == "production" else "debug"
+        self.logLevel = LOG_LEVELS[settings["logLevel"] if "logLevel" in settings else defaultLogLevel]
+        # per-rollout log calls are guarded by this flag, so when tracing is off they cost one test and build no strings
+        self.traceRollouts = self.profile != "production" and self.logLevel <= LOG_LEVELS["debug"]
+        # "queue": every process sends its messages to the logger process, "files": each process writes its own log file,
+        # "stdout": every process prints its messages directly (the default in in-process mode, which has no logger process)
+        self.logBackend = settings["logBackend"] if "logBackend" in settings else "stdout" if self.inProcess else "queue"
+        assert not (self.inProcess and self.logBackend == "queue"), "DshieldPlanner() ERROR! inProcess mode has no logger process for the queue log backend"
+        self.logDir = settings["logDir"] if "logDir" in settings else "plannerLogs"
+        self.logSink = None # LogSink of the current process, see getLogSink()
 
         # Internal initialization
         self.root = None
-        self.nextNodeId = 0
-        self.openNodes = []
-        self.allNodes = {}
+        self.tree = MctsTree() # array-backed tree (replaced by a SharedMctsTree in shared-memory mode)
         self.currentNode = None # newest child node, used by setNodeChoices and updateState
         self.stats = {}
-        self.rolloutStats = {}
+        self.rolloutStats = RolloutStats() # replaced in each worker by mcts()
+        self.rolloutChoiceCount = 0 # choice points with more than one choice in the current rollout
+        # The best plan is kept as the choice index taken at each multi-choice point of its rollout;
+        # the full application state is rebuilt once at the end by resimulatePlan()
+        self.rolloutChoiceIndexes = array("h")
+        self.forcedChoices = None # choice indexes replayed by resimulatePlan()
+        self.forcedChoicePosition = 0
+        # Per-stage timers (select, replay, expand, simulate, application, snapshot, score, backpropagate)
+        self.profileStages = settings["profileStages"] if "profileStages" in settings else True
+        self.profiler = None # StageProfiler, created in each worker by mcts()
+        # Per-worker memory budget (independent trees): when the tree reaches maxTreeNodes, or the process RSS
+        # reaches memoryBudgetMB, cold subtrees are pruned down to pruneKeepFraction of the tree.
+        # Neither applies to a shared tree (useSharedNodes), which is never pruned: sharedNodeCapacity bounds
+        # its size, and the search stops when it is full
+        self.maxTreeNodes = settings["maxTreeNodes"] if "maxTreeNodes" in settings else 0 # 0: no node limit
+        self.memoryBudgetMB = settings["memoryBudgetMB"] if "memoryBudgetMB" in settings else 0 # 0: no RSS limit
+        self.pruneKeepFraction = settings["pruneKeepFraction"] if "pruneKeepFraction" in settings else 0.5
+        self.memoryCheckInterval = settings["memoryCheckInterval"] if "memoryCheckInterval" in settings else 100 # rollouts between RSS checks
+        self.peakRssMB = 0
+        self.pruneCount = 0
+        self.prunedNodeCount = 0
+        self.rolloutPlannerSeconds = 0 # planner time spent inside the application method during the current rollout
         self.stage =  "select"   #select, replay, expand, simulate, backpropagate
         self.mostPlayedMove = None
         self.replayPlan = None
         self.replayNodeToExpand = None
+        self.rootChoices = None # choices at the root, used to label root moves created by other workers
         random.seed(self.randomSeed)
         self.randomChoicePct = None # set in each parallel process
         self.randomChoiceCount = 0
         self.totalChoiceCount = 0
+        self.rolloutCount = 0  # rollouts completed by this process
+        self.atRootChoice = False # True until the first choice point of a rollout which starts at the root
+        # Snapshot cache: lets a rollout resume from the application state at a cached ancestor instead of replaying from the root
+        self.snapshotFn = settings["snapshot"] if "snapshot" in settings else None # application method which returns its state
+        self.snapshotCacheMB = settings["snapshotCacheMB"] if "snapshotCacheMB" in settings else 0 # 0 disables the cache
+        self.snapshotMinVisits = settings["snapshotMinVisits"] if "snapshotMinVisits" in settings else 4
+        self.snapshotCache = None # created in each worker by mcts()
+        # Transposition table: nodes whose application states have the same hash share visit and reward statistics
+        self.stateHashFn = settings["stateHash"] if "stateHash" in settings else None # application method which hashes its state
+        self.transpositionTableSize = settings["transpositionTableSize"] if "transpositionTableSize" in settings else 0 # max entries, 0 disables the table
+        self.moveText = settings["moveText"] if "moveText" in settings else str # application method which formats a move for the log
+        # Receding-horizon planning: workers return their trees so the subtree below the committed moves can seed the next window
+        self.keepTrees = False
+        self.initialTrees = None # [tree or None] per worker, set by advanceRoot()
+        self.resumeSnapshot = None # application state to resume the current rollout from
+        self.lastMoveNodeId = None # tree node entered by the most recent replay/expand move
+        self.searchStartTime = None
+        self.searchDeadline = None # time.time() at which all workers stop, set by parallelMCTS() when timeLimit is set
+        self.stopReason = None
+        self.searching = False # True while start() runs, see plan()
 
         # Multiprocessing initialization
-        manager = mp.Manager()
-        self.appToPlannerQ     = manager.Queue()
-        self.appToControllerQ  = manager.Queue()
-        self.supToExecQ        = manager.Queue()
-        self.parallelResults = manager.list()
-        self.sharedDict = manager.dict()
-        self.loggerQ = manager.Queue()
-        self.logLock = manager.RLock()
+        if self.inProcess:
+            # nothing is shared with other processes (the Manager process alone takes longer to start than a small search)
+            self.appToPlannerQ     = None
+            self.appToControllerQ  = None
+            self.supToExecQ        = None
+            self.parallelResults = []
+            self.sharedDict = {}
+            self.bestPlanLock = threading.Lock() # getBestPlanSoFar() may be called from another thread
+            self.loggerQ = None
+            self.logLock = threading.RLock()
+            self.cancelEvent = threading.Event()
+        else:
+            manager = mp.Manager()
+            self.appToPlannerQ     = manager.Queue()
+            self.appToControllerQ  = manager.Queue()
+            self.supToExecQ        = manager.Queue()
+            self.parallelResults = manager.list()
+            self.sharedDict = manager.dict() # also holds the best plan found so far (see publishBestPlan)
+            self.bestPlanLock = manager.Lock()
+            self.loggerQ = manager.Queue()
+            self.logLock = manager.RLock()
+            self.cancelEvent = mp.Event() # set by cancel(); a plain semaphore, so workers can test it on every rollout
         self.planner         = None
         self.plannerPid = 0
         self.plannerProc = None
@@ -67,30 +186,98 @@ class DshieldPlanner:
         # Result data
         self.bestPlanNode = None
         self.bestPlanScore = 0
-        self.bestPlanState = None
+        self.bestPlanChoices = None # array of choice indexes of the best rollout
+        self.bestPlanState = None # set by start() from bestPlanChoices
+        if self.logBackend == "files":
+            self.initLogDir()
         print("Planner settings: "+str(self.settings))
 
     def start(self, appMethod):
         self.initStats()
-        loggerProc = mp.Process(target=self.loggerMsgHandler, args=(self.loggerQ,))
-        loggerProc.start()
-
+        loggerProc = None
         self.targetProcs = [appMethod.__name__]
         self.appMethod = appMethod
-
-        # start planner
-        self.planner = Supervisor(self, "planning",  self.logLock, self.loggerQ, self.sharedDict)
-        plannerProc = self.planner.start(self.appToPlannerQ)
-
-        self.sendStartMsgToPlanner()
-        self.logMsg("planner: "+str(self.planner))
-        plannerProc.join()
-        self.bestPlanState = self.sharedDict["bestPlanState"]
+        if self.inProcess:
+            self.inProcessMCTS(appMethod)
+        else:
+            if self.logBackend == "queue":
+                loggerProc = mp.Process(target=self.loggerMsgHandler, args=(self.loggerQ,))
+                loggerProc.start()
+
+            # start planner
+            self.planner = Supervisor(self, "planning",  self.logLock, self.loggerQ, self.sharedDict)
+            plannerProc = self.planner.start(self.appToPlannerQ)
+
+            self.sendStartMsgToPlanner()
+            self.logMsg("planner: "+str(self.planner))
+            plannerProc.join()
+        self.bestPlanChoices = self.sharedDict["bestPlanChoices"]
+        self.bestPlanScore = self.sharedDict["bestPlanScore"]
+        self.bestPlanState = None
+        if self.bestPlanChoices is not None:
+            score, self.bestPlanState = self.resimulatePlan(self.bestPlanChoices)
+            if abs(score - self.bestPlanScore) > 0.001:
+                self.logMsg("start() WARNING! resimulated best plan score "+str(score)+" differs from best score "+str(self.bestPlanScore))
         self.printStats()
-        self.loggerQ.put("LOGGER_EXIT")
+        if loggerProc:
+            self.loggerQ.put("LOGGER_EXIT")
+        elif self.logBackend == "files":
+            self.flushLog()
+            print("Planner log: "+self.mergeLogs())
         # print(str(self.bestPlanState))
 
 
+    # ASYNCIO API
+    # start() blocks until every worker has finished, so plan() runs it in a thread of the event loop's executor
+    # and bestPlanUpdates() polls the best plan the workers publish in sharedDict. Each request in flight
+    # needs its own planner (and application instance).
+
+    async def plan(self, appMethod):
+        # await the search; returns (best score, best plan state)
+        # cancelling the awaiting task stops the workers after their current rollout, then re-raises CancelledError
+        assert not self.searching, "plan() ERROR! this planner is already searching"
+        self.searching = True
+        self.cancelEvent.clear()
+        self.sharedDict["bestPlanScore"] = 0
+        self.sharedDict["bestPlanChoices"] = None
+        search = asyncio.get_running_loop().run_in_executor(None, self.start, appMethod)
+        try:
+            await asyncio.shield(search)
+        except asyncio.CancelledError:
+            self.cancel()
+            await asyncio.gather(search, return_exceptions=True) # workers and supervisor exit cleanly
+            raise
+        finally:
+            self.searching = False
+        return self.bestPlanScore, self.bestPlanState
+
+    async def bestPlanUpdates(self, appMethod, pollInterval=0.5):
+        # async iterator of improving results: yields {"score", "choices", "elapsed"} each time the best score
+        # of the running search improves, then the final result (with "state") once the search is done.
+        # Leaving the loop early cancels the search.
+        startTime = time.time()
+        search = asyncio.ensure_future(self.plan(appMethod))
+        bestScore = 0
+        try:
+            while not search.done():
+                await asyncio.wait([search], timeout=pollInterval)
+                if search.done():
+                    break
+                score, choices = self.getBestPlanSoFar()
+                if score > bestScore:
+                    bestScore = score
+                    yield {"score": score, "choices": choices, "elapsed": round(time.time() - startTime, 3)}
+            score, state = search.result()
+            yield {"score": score, "choices": self.bestPlanChoices, "elapsed": round(time.time() - startTime, 3), "state": state}
+        finally:
+            if not search.done():
+                search.cancel()
+                await asyncio.gather(search, return_exceptions=True)
+
+    def cancel(self):
+        # stop a running search (any thread): workers finish their current rollout and return their results
+        self.cancelEvent.set()
+
     def sendStartMsgToPlanner(self):
         self.logMsg("sendStartMsgToPlanner() starting planner")
         msg = {"type": "start", "execPid": os.getpid()}
@@ -99,20 +286,48 @@ class DshieldPlanner:
     def parallelMCTS(self, applicationMethod, processCount):
         startTimestamp = self.timestamp()
         startTime = time.time()
-        self.logMsg("\nparallelMCTS() processCount: "+str(processCount)+", sharedNodes: "+str(self.useSharedNodes)+", start time: "+startTimestamp)
+        if self.plannerTimeLimitSeconds:
+            # anytime mode: every worker stops at the same wall-clock deadline
+            self.searchDeadline = startTime + self.plannerTimeLimitSeconds
+        self.sharedDict["bestPlanScore"] = 0
+        self.sharedDict["bestPlanChoices"] = None
+        self.sharedDict["bestPlanTime"] = startTime
+        if self.workerAddresses:
+            self.distributedMCTS(applicationMethod)
+            return
         procs = []
+        del self.parallelResults[:] # results of a previous window
         randomChoicePct = 0
         pctIncrement = math.ceil(100/processCount)
-        manager = mp.Manager()
-        self.sharedNodes = manager.list()
-        self.sharedNodesLock = manager.RLock()
+        self.useManagerNodes = self.useSharedNodes and self.sharedNodeBackend == "manager"
+        self.useTreeParallel = self.useSharedNodes and not self.useManagerNodes and self.treeParallel
+        self.logMsg("\nparallelMCTS() processCount: "+str(processCount)+", sharedNodes: "+str(self.useSharedNodes)+" ("+self.sharedNodeBackend+")"+", treeParallel: "+str(self.useTreeParallel)+", start time: "+startTimestamp)
+        if self.useSharedNodes and not self.useManagerNodes:
+            # one shared-memory tree for all workers; each rollout adds at most one node
+            if "sharedNodeCapacity" in self.settings:
+                capacity = self.settings["sharedNodeCapacity"]
+            elif self.rolloutLimit:
+                capacity = (self.rolloutLimit + 1) * processCount + 1 # isSearchComplete() keeps one node per worker in reserve
+            else:
+                capacity = 1000000 # time-limited search: workers stop early if the tree fills up
+            self.tree = SharedMctsTree(capacity)
+            self.sharedNodes = self.tree
+            self.sharedNodesLock = mp.RLock()
+        else:
+            manager = mp.Manager()
+            self.sharedNodes = manager.list()
+            self.sharedNodesLock = manager.RLock()
+            self.rootStatsDict = manager.dict() if self.rootSyncInterval and not self.useSharedNodes else None
         if self.useSharedNodes:
             self.createRootNode()
+        self.convergedVotes = mp.Array("b", processCount, lock=False) if self.checkConvergence and processCount > 1 else None
         for i in range(processCount):
+            self.workerIndex = i # copied into the worker by fork
+            initialTree = self.initialTrees[i] if self.initialTrees and i < len(self.initialTrees) else None
             if self.settings["greedy"] or self.settings["allGreedy"]:
-                p = mp.Process(target=self.mcts, args=(applicationMethod,self.parallelResults, randomChoicePct, self.sharedNodes, self.sharedNodesLock))
+                p = mp.Process(target=self.mcts, args=(applicationMethod,self.parallelResults, randomChoicePct, self.sharedNodes, self.sharedNodesLock, initialTree))
             else:
-                p = mp.Process(target=self.mcts, args=(applicationMethod,self.parallelResults, 100, self.sharedNodes, self.sharedNodesLock))
+                p = mp.Process(target=self.mcts, args=(applicationMethod,self.parallelResults, 100, self.sharedNodes, self.sharedNodesLock, initialTree))
             p.start()
             procs.append(p)
             if self.settings["greedy"] and not self.settings["allGreedy"]:
@@ -121,52 +336,269 @@ class DshieldPlanner:
         for p in procs:
             p.join()
         # self.printTree()
+        self.selectBestResult()
+        self.printParallelResults()
+        if self.useSharedNodes and not self.useManagerNodes:
+            self.logMsg("parallelMCTS() shared tree nodes: "+str(self.tree.nodeCount()))
+            self.tree.close()
+            self.tree.unlink()
+        elapsedTime = round(time.time() - startTime, 3)
+        self.logMsg("parallelMCTS() done. Start: "+startTimestamp+", end "+self.timestamp()+", elapsed: "+str(elapsedTime), True)
+
+    def inProcessMCTS(self, applicationMethod, randomChoicePct=None):
+        # inProcess mode: run the search of a single parallelMCTS() worker in this process (independent tree)
+        # (also used by distributed workers, which pass their randomChoicePct)
+        startTime = time.time()
+        self.searchDeadline = startTime + self.plannerTimeLimitSeconds if self.plannerTimeLimitSeconds else None
+        self.sharedDict["bestPlanScore"] = 0
+        self.sharedDict["bestPlanChoices"] = None
+        self.sharedDict["bestPlanTime"] = startTime
+        del self.parallelResults[:] # results of a previous window
+        self.useSharedNodes = False
+        self.useManagerNodes = False
+        self.useTreeParallel = False
+        # per-search state which forked workers get fresh from their parent
+        self.tree = MctsTree() # the previous search's tree may be kept by its results (keepTrees)
+        self.snapshotCache = None
+        self.stopReason = None
+        self.randomChoiceCount = 0
+        self.totalChoiceCount = 0
+        initialTree = self.initialTrees[0] if self.initialTrees else None
+        if randomChoicePct is None:
+            randomChoicePct = 0 if self.settings["greedy"] or self.settings["allGreedy"] else 100
+        self.logMsg("\ninProcessMCTS() start time: "+self.timestamp())
+        self.mcts(applicationMethod, self.parallelResults, randomChoicePct, None, None, initialTree)
+        self.printParallelResults()
+        self.logMsg("inProcessMCTS() done. Elapsed: "+str(round(time.time() - startTime, 3)), True)
+
+    def distributedMCTS(self, applicationMethod):
+        # root-parallel search on remote workers: the problem (application instance) is serialized once and sent
+        # to every worker, each worker searches its own tree with its own seed and randomChoicePct,
+        # and its collectParallelResults() payload is added to parallelResults
+        startTime = time.time()
+        del self.parallelResults[:]
+        problem = distributedSearch.packProblem(applicationMethod, self.settings)
+        self.logMsg("\ndistributedMCTS() workers: "+str(len(self.workerAddresses))+", problem size: "+str(len(problem))+" bytes, start time: "+self.timestamp())
+        randomChoicePct = 0
+        pctIncrement = math.ceil(100/len(self.workerAddresses))
+        connections = []
+        try:
+            for i, address in enumerate(self.workerAddresses):
+                conn = socket.create_connection(distributedSearch.parseAddress(address))
+                connections.append(conn)
+                initialTree = self.initialTrees[i] if self.initialTrees and i < len(self.initialTrees) else None
+                distributedSearch.sendMsg(conn, {"type": "problem", "problem": problem})
+                distributedSearch.sendMsg(conn, {"type": "search", "seed": self.randomSeed + i,
+                                                 "randomChoicePct": randomChoicePct if self.settings["greedy"] or self.settings["allGreedy"] else 100,
+                                                 "rolloutLimit": self.rolloutLimit, "timeLimit": self.plannerTimeLimitSeconds,
+                                                 "keepTrees": self.keepTrees, "initialTree": initialTree})
+                if self.settings["greedy"] and not self.settings["allGreedy"]:
+                    randomChoicePct = min(randomChoicePct + pctIncrement, 100)
+            # the workers search concurrently; collect their results in order
+            for address, conn in zip(self.workerAddresses, connections):
+                msg = distributedSearch.recvMsg(conn)
+                assert msg["type"] == "result", "distributedMCTS() ERROR! worker "+str(address)+": "+str(msg["message"] if "message" in msg else msg)
+                msg["result"]["worker"] = address
+                self.parallelResults.append(msg["result"])
+                distributedSearch.sendMsg(conn, {"type": "close"})
+        finally:
+            for conn in connections:
+                conn.close()
+        self.selectBestResult()
+        self.sharedDict["bestPlanScore"] = self.bestPlanScore
+        self.sharedDict["bestPlanChoices"] = self.bestPlanChoices
+        self.printParallelResults()
+        self.logMsg("distributedMCTS() done. Elapsed: "+str(round(time.time() - startTime, 3)), True)
+
+    def selectBestResult(self):
+        # best plan of all workers' results
         self.bestPlanScore = 0
         for treeResult in self.parallelResults:
             treeBestScore = treeResult["bestScore"]
             if treeBestScore > self.bestPlanScore:
                 self.bestPlanScore = treeBestScore
-                self.bestPlanState = treeResult["bestState"]
-        self.printParallelResults()
-        elapsedTime = round(time.time() - startTime, 3)
-        self.logMsg("parallelMCTS() done. Start: "+startTimestamp+", end "+self.timestamp()+", elapsed: "+str(elapsedTime), True)
+                self.bestPlanChoices = treeResult["bestChoices"]
 
-    def mcts(self, applicationMethod, parallelResults, randomChoicePct, sharedNodes, sharedNodesLock):
+    def mcts(self, applicationMethod, parallelResults, randomChoicePct, sharedNodes, sharedNodesLock, initialTree=None):
         self.randomChoicePct = randomChoicePct
         self.sharedNodes = sharedNodes
         self.sharedNodesLock = sharedNodesLock
-        self.logMsg("\nmcts() rollout limit: "+str(self.rolloutLimit) +", randomChoicePct: "+str(self.randomChoicePct))
-        if self.useSharedNodes:
+        self.logMsg("\nmcts() rollout limit: "+str(self.rolloutLimit) +", time limit: "+str(self.plannerTimeLimitSeconds)+", randomChoicePct: "+str(self.randomChoicePct))
+        if self.useManagerNodes:
             self.root = self.sharedNodes[0]
             self.logMsg("mcts: root: "+str(self.root)+", sharedRoot: "+str(self.sharedNodes[0]))
+        elif self.useSharedNodes:
+            self.tree = sharedNodes
+            self.root = self.tree.getNode(1)
+        elif initialTree:
+            # receding horizon: continue from the subtree kept by advanceRoot()
+            self.tree = initialTree
+            self.root = self.tree.getNode(1)
+            self.logMsg("mcts() reusing subtree: "+str(self.root))
         else:
             self.createRootNode()
+        if self.snapshotFn and self.snapshotCacheMB and not self.useManagerNodes:
+            self.snapshotCache = SnapshotCache(self.snapshotCacheMB * 1000000, self.snapshotMinVisits)
+        if self.stateHashFn and self.transpositionTableSize and not self.useSharedNodes:
+            self.tree.transpositions = TranspositionTable(self.transpositionTableSize)
 
-        # do rollouts
+        # do rollouts (the best plan of a previous window is inherited through fork, so start over)
+        self.bestPlanScore = 0
+        self.bestPlanNode = None
+        self.bestPlanChoices = None
+        self.rolloutStats = RolloutStats(self.rolloutLimit or 0)
+        self.initConvergence()
+        self.profiler = StageProfiler() if self.profileStages else None
+        self.searchStartTime = time.time()
+        self.searchStartCpu = time.process_time()
         rolloutCount = 1
-        while rolloutCount <= self.rolloutLimit:
+        while not self.isSearchComplete(rolloutCount):
             self.doRollout(rolloutCount, applicationMethod)
+            if not self.useSharedNodes:
+                self.enforceMemoryBudget(rolloutCount)
+            if self.rootStatsDict is not None and rolloutCount % self.rootSyncInterval == 0:
+                self.syncRootStats()
             rolloutCount += 1
+        self.rolloutCount = rolloutCount - 1
+        if self.convergedVotes is not None:
+            self.convergedVotes[self.workerIndex] = 1 # a stopped worker does not hold back the others
+        self.logMsg("mcts() stopped after "+str(self.rolloutCount)+" rollouts: "+self.stopReason+", rollouts/sec: "+str(self.rolloutsPerSec()))
 
         # print results
         print("random choices: "+str(self.randomChoiceCount)+"/"+str(self.totalChoiceCount)+" = "+str(round(self.randomChoiceCount/self.totalChoiceCount, 3)))
 
         # For "execution", incrementally return single next best move (not used)
         self.collectParallelResults(parallelResults)
+        if self.useSharedNodes and not self.useManagerNodes:
+            self.tree.close()
+        self.flushLog()
 
         # self.getMostPlayedNextMove()
         # bestMove = self.mostPlayedMove.priorMove
         # self.logMsg("bestMove: "+str(bestMove))
 
+    # CONVERGENCE
+
+    def initConvergence(self):
+        # per-search state of the convergence criteria
+        self.convergenceReason = None
+        self.convergenceBestScore = 0
+        self.lastImprovementRollout = 0
+        self.rootShares = None
+        self.stableRootChecks = 0
+
+    def isConverged(self, rolloutCount):
+        # rolloutCount: rollouts completed by this worker. Each worker votes in convergedVotes; the search
+        # has converged once this worker's criteria hold and every other worker has voted (or stopped)
+        self.convergenceReason = self.convergenceCriterion(rolloutCount)
+        if self.convergedVotes is None:
+            return self.convergenceReason is not None
+        self.convergedVotes[self.workerIndex] = 1 if self.convergenceReason else 0
+        return self.convergenceReason is not None and all(self.convergedVotes)
+
+    def convergenceCriterion(self, rolloutCount):
+        # returns a description of the first criterion which holds, or None
+        bestScore = self.sharedDict["bestPlanScore"] # best of all workers
+        if bestScore > self.convergenceBestScore:
+            self.convergenceBestScore = bestScore
+            self.lastImprovementRollout = rolloutCount
+        rootStable = self.rootStabilityThreshold and self.isRootStable()
+        if self.stallRollouts and rolloutCount - self.lastImprovementRollout >= self.stallRollouts:
+            return "no improvement in "+str(self.stallRollouts)+" rollouts"
+        if self.stallSeconds and time.time() - self.sharedDict["bestPlanTime"] >= self.stallSeconds:
+            return "no improvement in "+str(self.stallSeconds)+" seconds"
+        if rootStable:
+            return "root visits stable for "+str(self.rootStabilityChecks)+" checks"
+        return None
+
+    def isRootStable(self):
+        # compare the share of root visits of each root move with the previous check
+        visits = [self.getNode(childId).visitCount for childId in self.root.children]
+        total = sum(visits)
+        shares = [count / total for count in visits] if total else []
+        previousShares = self.rootShares
+        self.rootShares = shares
+        if not previousShares or len(previousShares) != len(shares):
+            self.stableRootChecks = 0 # a new root move was expanded
+        elif max(abs(share - previous) for share, previous in zip(shares, previousShares)) < self.rootStabilityThreshold:
+            self.stableRootChecks += 1
+        else:
+            self.stableRootChecks = 0
+        return self.stableRootChecks >= self.rootStabilityChecks
+
+    def logStopReasons(self):
+        # {stop reason: worker count} and total rollouts of all workers
+        reasons = {}
+        for treeResult in self.parallelResults:
+            reason = treeResult["stopReason"]
+            reasons[reason] = reasons[reason] + 1 if reason in reasons else 1
+        rollouts = sum(treeResult["rollouts"] for treeResult in self.parallelResults)
+        self.logMsg("Search stopped: "+", ".join(reason+" ("+str(count)+" workers)" for reason, count in reasons.items())+", rollouts (all workers): "+str(rollouts))
+
+    def rolloutsPerSec(self):
+        elapsed = time.time() - self.searchStartTime
+        return round(self.rolloutCount / elapsed, 1) if elapsed > 0 else 0
+
+    def isSearchComplete(self, rolloutCount):
+        # checked before each rollout, so a worker may overrun the deadline by at most one rollout
+        if self.rolloutLimit and rolloutCount > self.rolloutLimit:
+            self.stopReason = "rollout limit"
+        elif self.searchDeadline and time.time() >= self.searchDeadline:
+            self.stopReason = "time limit"
+        elif self.useSharedNodes and not self.useManagerNodes and self.tree.size() + self.processCount > self.tree.capacity:
+            self.stopReason = "shared tree full" # leave room for one more node per worker
+        elif self.cancelEvent.is_set():
+            self.stopReason = "cancelled"
+        elif self.checkConvergence and rolloutCount > 1 and (rolloutCount - 1) % self.convergenceCheckInterval == 0 and self.isConverged(rolloutCount - 1):
+            self.stopReason = "converged ("+self.convergenceReason+")"
+        return self.stopReason is not None
+
     def doRollout(self, rolloutNumber, applicationMethod):
         rolloutStart = time.time()
-        self.logMsg("\n=========\nRollout "+str(rolloutNumber))
+        if self.traceRollouts:
+            self.logMsg("\n=========\nRollout "+str(rolloutNumber))
         self.setStage("select")
         self.currentNode = None
-        applicationMethod()  # run user application-level code
+        self.resumeSnapshot = None
+        self.virtualLossPath = None
+        self.rolloutChoiceCount = 0
+        del self.rolloutChoiceIndexes[:]
+        if self.useSharedNodes and not self.useTreeParallel:
+            self.sharedNodesLock.acquire()  # released by expandLeaf before starting simulate stage
+            self.holdingNodesLock = True
+        try:
+            # select before running the application so that it can resume from a cached snapshot
+            lapStart = time.perf_counter()
+            self.selectLeaf()
+            if self.stage == "exhausted":
+                self.releaseNodesLock() # nothing to expand
+            lapStart = self.profileLap("select", lapStart)
+            self.atRootChoice = self.resumeSnapshot is None
+            self.rolloutPlannerSeconds = 0
+            applicationMethod()  # run user application-level code
+            lapStart = self.profileLap("application", lapStart, self.rolloutPlannerSeconds)
+        finally:
+            # the rollout never reached expand: no multi-choice point after the replay, or the application raised
+            self.releaseNodesLock()
         score = self.rolloutScore()
+        lapStart = self.profileLap("score", lapStart)
         self.updateTree(self.currentNode, score)
-        self.stopRolloutStats(rolloutStart, rolloutNumber)
+        self.profileLap("backpropagate", lapStart)
+        self.stopRolloutStats(rolloutStart, score)
+
+    def profileLap(self, stage, lapStart, excludedSeconds=0):
+        # add the time since lapStart, less time already charged to other stages, to stage; returns the next lap start
+        lapEnd = time.perf_counter()
+        if self.profiler:
+            self.profiler.add(stage, lapEnd - lapStart - excludedSeconds)
+        return lapEnd
+
+    def addPlannerTime(self, stage, start):
+        # charge planner work done inside the application method (choice points, snapshots) to stage
+        elapsed = time.perf_counter() - start
+        self.rolloutPlannerSeconds += elapsed
+        if self.profiler:
+            self.profiler.add(stage, elapsed)
 
 
 
@@ -183,56 +615,93 @@ class DshieldPlanner:
             return None
         elif len(choices) == 1:
             return choices[0]
-        # Multiple choices exist so do MCTS
-        nodeToExpand = None
-        if self.stage == "select":
-            # select leaf node and update stage to replay or expand
-            if self.useSharedNodes:
-                self.sharedNodesLock.acquire()  # released by expandLeaf before starting simulate stage
-                # self.logMsg("acquire lock")
+        if self.forcedChoices is not None:
+            return self.forcedChoice(choices)
+        # Multiple choices exist so do MCTS (leaf was selected by doRollout)
+        start = time.perf_counter()
+        stage = self.stage
+        choice = self.chooseMctsValue(choicesDict, choiceSorter)
+        self.rolloutChoiceIndexes.append(choices.index(choice))
+        self.addPlannerTime(stage, start)
+        return choice
 
-            nodeToExpand = self.selectLeaf(varName)
+    def forcedChoice(self, choices):
+        # resimulatePlan(): take the recorded choice instead of searching
+        assert self.forcedChoicePosition < len(self.forcedChoices), "forcedChoice() ERROR! more choice points than recorded choices: "+str(len(self.forcedChoices))
+        choiceIndex = self.forcedChoices[self.forcedChoicePosition]
+        self.forcedChoicePosition += 1
+        assert choiceIndex < len(choices), "forcedChoice() ERROR! choice index "+str(choiceIndex)+" not in choices: "+str(choices)
+        return choices[choiceIndex]
+
+    def resimulatePlan(self, choiceIndexes):
+        # rebuild the full application state of a rollout by running the application once more,
+        # taking the recorded choice at each multi-choice point (the application is deterministic given its choices)
+        self.forcedChoices = choiceIndexes
+        self.forcedChoicePosition = 0
+        self.resumeSnapshot = None
+        self.lastMoveNodeId = None
+        self.currentNode = None
+        try:
+            self.appMethod()
+            score, state = self.settings["objective"]()
+        finally:
+            self.forcedChoices = None
+        assert self.forcedChoicePosition == len(choiceIndexes), "resimulatePlan() ERROR! used "+str(self.forcedChoicePosition)+" of "+str(len(choiceIndexes))+" choices"
+        return score, state
+
+    def chooseMctsValue(self, choicesDict, choiceSorter):
+        choices = choicesDict["choices"]
+        varName = choicesDict["varName"]
+        self.rolloutChoiceCount += 1
+        if self.atRootChoice:
+            self.rootChoices = choices
+            self.atRootChoice = False
         if self.stage == "replay":
             # choose next move in replay plan if selected node is not root
             choice = self.replay(choices, varName)
         elif self.stage == "expand":
             # expand the selected leaf node
-            if not nodeToExpand and self.replayNodeToExpand:
+            if self.traceRollouts:
                 self.logMsg("expand() continue after replay plan")
-                nodeToExpand = self.replayNodeToExpand
-            choice = self.expandLeaf(nodeToExpand, choicesDict, choiceSorter)
+            choice = self.expandLeaf(self.replayNodeToExpand, choicesDict, choiceSorter)
         elif self.stage == "simulate":
             # simulate remaining choices in rollout
             choice = self.simulate(choicesDict, choiceSorter)
         return choice
 
-    def selectLeaf(self, varName):
+    def selectLeaf(self):
         # descend tree (iteratively) to find a leaf (node with unexplored choices).
         # return choice (edge label) after traversing each edge
         # sets stage to expand if selected node is root otherwise sets stage to replay
         # sets replay plan if selected is not root
-        self.logMsg("selectLeaf() varName: "+str(varName))
+        if self.traceRollouts:
+            self.logMsg("selectLeaf()")
 
         node = self.root
-        if self.useSharedNodes:
+        if self.useManagerNodes:
             node = self.sharedNodes[0]
             self.root = node
+            # print("root: "+str(node))
+            while node.hasChildren() and not node.isLeaf():
+                nodeId = self.getBestChild(node)
+                node = self.getNode(nodeId) # refetch node from sharedNodes
+        elif self.useTreeParallel:
+            nodeId, self.virtualLossPath = self.tree.selectLeafWithVirtualLoss(self.root.id, self.virtualLoss)
+            node = self.tree.getNode(nodeId)
         else:
-            node = self.root
-        # print("root: "+str(node))
-        while node.hasChildren() and not node.isLeaf():
-            nodeId = self.getBestChild(node)
-            node = self.getNode(nodeId) # refetch node from sharedNodes
+            node = self.tree.getNode(self.tree.selectLeaf(self.root.id))
         selectedNode = node if node.isLeaf() else None
-        self.logMsg("selectLeaf() varName: "+str(varName)+", selected node: "+str(selectedNode))
+        if self.traceRollouts:
+            self.logMsg("selectLeaf() selected node: "+str(selectedNode))
 
         if selectedNode:
+            self.replayNodeToExpand = selectedNode
             if selectedNode.id != self.root.id:
                 self.collectReplayPlan(selectedNode)
-                node = self.getNode(nodeId)
-                self.replayNodeToExpand = node
-                self.currentNode = node
-                self.setStage("replay")
+                self.currentNode = selectedNode
+                if self.snapshotCache:
+                    self.resumeFromCachedAncestor()
+                self.setStage("replay" if self.replayPlan else "expand")
             else:
                 self.setStage("expand") # continue to next stage
         else:
@@ -241,23 +710,24 @@ class DshieldPlanner:
         return selectedNode
 
     def replay(self, choices, varName):
-        self.logMsg("replay() varName: "+str(varName)+", choices: "+str(choices)+", replayNodeToExpand: "+str(self.replayNodeToExpand))
-        if self.replayNodeToExpand.status == "init":
-            # set choices for node before next select stage
-            self.setNodeChoices(self.replayNodeToExpand, choices)
-        choice = self.getNextReplayMove()
-        # self.logMsg("replay() choices: "+str(choices) +" stage: "+str(self.stage) + ", Replay choice: "+str(choice))
-        if choice not in choices:
+        if self.traceRollouts:
+            self.logMsg("replay() varName: "+str(varName)+", choices: "+str(choices)+", replayNodeToExpand: "+str(self.replayNodeToExpand))
+        # choices belong to the replayed ancestor, so the selected node's own choices are set later by expandLeaf
+        moveIndex, self.lastMoveNodeId = self.getNextReplayMove()
+        # self.logMsg("replay() choices: "+str(choices) +" stage: "+str(self.stage) + ", Replay choice: "+str(moveIndex))
+        if not 0 <= moveIndex < len(choices):
             self.logMsg("BUG!! varName: "+str(varName) +", replayNodeToExpand: "+str(self.replayNodeToExpand)+", replayPlan: "+str(self.replayPlan))
-            self.logMsg("replay() choices: "+str(choices) +" stage: "+str(self.stage) + ", Replay choice: "+str(choice))
+            self.logMsg("replay() choices: "+str(choices) +" stage: "+str(self.stage) + ", Replay choice index: "+str(moveIndex))
             self.printPathFromRoot(self.replayNodeToExpand)
-        assert choice in choices, "ERROR! replay choice "+str(choice) + " not in choices: "+str(choices)
+        assert 0 <= moveIndex < len(choices), "ERROR! replay choice index "+str(moveIndex) + " not in choices: "+str(choices)
+        choice = choices[moveIndex]
         if not self.replayPlan:
             self.setStage("expand")
         return choice
 
     def expandLeaf(self, node, choicesDict, choiceSorter):
-        self.logMsg("expandLeaf() node: "+str(node)+", choicesDict: "+str(choicesDict))
+        if self.traceRollouts:
+            self.logMsg("expandLeaf() node: "+str(node)+", choicesDict: "+str(choicesDict))
         # randomly select an unexplored  choice
         choices = choicesDict["choices"]
         if node.status == "init":
@@ -265,7 +735,43 @@ class DshieldPlanner:
             self.setNodeChoices(node, choices)
 
         # TODO: BUG? Why does node.unexploredChoices != choices
-        choices = node.unexploredChoices
+        allChoices = choices
+        if self.useTreeParallel:
+            choice = self.tree.claimChoice(node.id, allChoices, lambda unexplored: self.pickExpandChoice(unexplored, choicesDict, choiceSorter))
+            if choice is None:
+                # another worker expanded the node's last choice after we selected it: simulate from the node instead
+                choicesDict["choices"] = allChoices
+                self.setCurrentNode(node)
+                self.setStage("simulate")
+                return self.simulate(choicesDict, choiceSorter)
+            choices = choicesDict["choices"]
+        else:
+            choices = node.getUnexploredChoices(allChoices)
+            choice = self.pickExpandChoice(choices, choicesDict, choiceSorter)
+            node.removeUnexploredChoice(choice, allChoices)
+            self.updateSharedNode(node)
+        if self.traceRollouts:
+            self.logMsg("expandLeaf() "+str(node) +" with choice "+str(choice))
+        if not node.isLeaf():
+            # all choices have been explored
+            node.status = "exhausted"
+        child = self.createChildNode(node, choicesDict["varName"], choice, allChoices.index(choice))
+        self.lastMoveNodeId = child.id
+        self.setCurrentNode(child) # remember child to set choices on next call to chooseValue
+        if self.traceRollouts:
+            self.logMsg("expandLeaf() choices: "+str(choices) +" stage: "+str(self.stage)+", choice: "+str(choice))
+        self.setStage("simulate")
+        self.releaseNodesLock()
+        return choice
+
+    def releaseNodesLock(self):
+        # release sharedNodesLock if doRollout() took it and it has not been released yet
+        if self.holdingNodesLock:
+            self.holdingNodesLock = False
+            self.sharedNodesLock.release()
+
+    def pickExpandChoice(self, choices, choicesDict, choiceSorter):
+        # choose one of the leaf's unexplored choices
         choicesDict["choices"] = choices
         if choiceSorter:
             if choiceSorter == "random":
@@ -277,19 +783,6 @@ class DshieldPlanner:
                 choice = choiceSorter(choicesDict)[0]
         else:
             choice = choices[0] # default to the choices order
-        node.unexploredChoices.remove(choice)
-        self.updateSharedNode(node)
-        self.logMsg("expandLeaf() "+str(node) +" with choice "+str(choice))
-        if not node.isLeaf():
-            # all choices have been explored
-            node.status = "exhausted"
-        child = self.createChildNode(node, choicesDict["varName"], choice)
-        self.setCurrentNode(child) # remember child to set choices on next call to chooseValue
-        self.logMsg("expandLeaf() choices: "+str(choices) +" stage: "+str(self.stage)+", choice: "+str(choice))
-        self.setStage("simulate")
-        if self.useSharedNodes:
-            # self.logMsg("release lock")
-            self.sharedNodesLock.release()
         return choice
 
     def simulate(self, choicesDict, choiceSorter):
@@ -307,7 +800,7 @@ class DshieldPlanner:
                     choice = random.choice(choices)
                     self.randomChoiceCount += 1
                     # print("Random Choice %: "+str(self.randChoicePct) + ", diceRoll: "+str(diceRoll)+", random choice: "+str(choice))
-            if not choice:
+            if choice is None:
                 choice = choiceSorter(choicesDict)[0]
         else:
             self.totalChoiceCount += 1
@@ -317,6 +810,7 @@ class DshieldPlanner:
         return choice
 
     def getBestChild(self, parent):
+        # Manager-node backend only; MctsTree.bestChild() computes the same choice from the tree columns
         # self.printTree()
         # calculate normalized scores (ranks) for each existing child
         childRewards = [] # avgObjectiveFunction Rewards
@@ -344,13 +838,11 @@ class DshieldPlanner:
 
         # calculate UCT scores for each child
         c = math.sqrt(2)
-        parent.visitCount = max(parent.visitCount, 1)  # TODO: fix this hack (why does visitCount = 0?)
-        parentVisits = 2 * math.log(parent.visitCount)
+        parentVisits = 2 * math.log(max(parent.visitCount, 1)) # unvisited nodes count as visited once
         uctScores = []
         for childId in normalizedScores:
             child = self.getNode(childId)
-            child.visitCount = max(child.visitCount,1) # TODO: fix this hack (why does visitCount = 0?)
-            uctScore = normalizedScores[childId] + (c * math.sqrt(parentVisits/child.visitCount))
+            uctScore = normalizedScores[childId] + (c * math.sqrt(parentVisits/max(child.visitCount, 1)))
             uctScores.append((childId,uctScore))
 
         # choose child with best score
@@ -366,27 +858,58 @@ class DshieldPlanner:
         if score > self.bestPlanScore:
             self.bestPlanScore = score
             self.bestPlanNode = self.currentNode
-            self.bestPlanState = copy.copy(state)
+            self.bestPlanChoices = array("h", self.rolloutChoiceIndexes) # state is rebuilt from these at the end
+            self.publishBestPlan()
         return score
 
+    def publishBestPlan(self):
+        # keep the best plan of all workers in sharedDict so it can be taken before the search finishes
+        with self.bestPlanLock:
+            if self.bestPlanScore > self.sharedDict["bestPlanScore"]:
+                self.sharedDict["bestPlanScore"] = self.bestPlanScore
+                self.sharedDict["bestPlanChoices"] = self.bestPlanChoices
+                self.sharedDict["bestPlanElapsed"] = round(time.time() - self.searchStartTime, 3)
+                self.sharedDict["bestPlanTime"] = time.time()
+
+    def getBestPlanSoFar(self):
+        # safe to call from any process (or thread) while the search is running
+        # returns (score, choice indexes) of the best rollout so far, (0, None) before the first rollout completes
+        # (resimulatePlan() turns the choices into the application state)
+        return self.sharedDict["bestPlanScore"], self.sharedDict["bestPlanChoices"]
+
     def setNodeChoices(self, node, choices):
+        if not self.useManagerNodes:
+            # tree nodes only take their choices once (under a per-node lock in a SharedMctsTree)
+            node.setChoices(choices)
+            if self.traceRollouts:
+                self.logMsg("setNodeChoices() node " + str(node.id) + " set choices: " + str(choices)+", result: "+str(node))
+            return
         with self.sharedNodesLock:
-            self.logMsg("setNodeChoices() node " + str(node.id) + " set choices: " + str(choices))
-            node.unexploredChoices = copy.copy(choices)  # TODO: is this copy required?
-            node.status = "open"
+            if self.traceRollouts:
+                self.logMsg("setNodeChoices() node " + str(node.id) + " set choices: " + str(choices))
+            if self.getNode(node.id).status != "init":
+                return # another worker has already set this node's choices
+            node.setChoices(choices)
             self.updateSharedNode(node)
             node = self.getNode(node.id)
-            self.logMsg("setNodeChoices() result: "+str(node))
+            if self.traceRollouts:
+                self.logMsg("setNodeChoices() result: "+str(node))
 
     def updateNodeScore(self, score):
         # called by application code
         if self.currentNode:
-            self.currentNode.score = score
+            self.currentNode.planScore = score
 
     def updateTree(self, child, score):
         # Backpropagate rollout rewards and update MCTS stats
         # Climb up tree from child through ancestors to root
         # self.logMsg("updateTree() child: "+str(child))
+        if not self.useManagerNodes:
+            if self.virtualLossPath:
+                self.tree.removeVirtualLoss(self.virtualLossPath, self.virtualLoss)
+                self.virtualLossPath = None
+            self.tree.backpropagate(child.id, self.roundIt(score), score)
+            return
         with self.sharedNodesLock:
             child.totalReward += self.roundIt(score)
             child.visitCount += 1
@@ -404,29 +927,98 @@ class DshieldPlanner:
 
     def collectReplayPlan(self, node):
         # collects plan in reverse order so pop() can be used
-        self.logMsg("collectReplayPlan() node: "+str(node))
-        with self.sharedNodesLock:
-            self.replayPlan = []
-            self.collectReplayPlanRecursive(self.getNode(node.id))
-        self.logMsg("collectReplayPlan() result: "+str(list(reversed(self.replayPlan))))
+        if self.traceRollouts:
+            self.logMsg("collectReplayPlan() node: "+str(node))
+        if self.useManagerNodes:
+            with self.sharedNodesLock:
+                self.replayPlan = self.collectReplayPlanFromNode(self.getNode(node.id))
+        else:
+            self.replayPlan = self.tree.pathMoves(node.id) # parent links and move indexes never change once set
+        if self.traceRollouts:
+            self.logMsg("collectReplayPlan() result: "+str(list(reversed(self.replayPlan))))
 
-    def collectReplayPlanRecursive(self, node):
-        # RECURSIVE
-        # collect all plan choices from root to node (SCRs)
-        if node.priorMove:
-            self.replayPlan.append(node.priorMove)
-            self.collectReplayPlanRecursive(self.getNode(node.parent))
+    def collectReplayPlanFromNode(self, node):
+        # collect (choice index, node id) pairs from node up to root (SCRs), walking parent ids iteratively
+        replayPlan = []
+        while node.parent:
+            replayPlan.append((node.moveIndex, node.id))
+            node = self.getNode(node.parent)
+        return replayPlan
 
     def collectParallelResults(self, parallelResults):
-        treeResults = {"bestScore": self.bestPlanScore, "bestState": self.bestPlanState,"randomPct": self.randomChoicePct}
+        treeResults = {"bestScore": self.bestPlanScore, "bestChoices": self.bestPlanChoices,"randomPct": self.randomChoicePct}
+        treeResults.update({"rollouts": self.rolloutCount, "searchSeconds": time.time() - self.searchStartTime, "stopReason": self.stopReason,
+                            "rolloutsPerSec": self.rolloutsPerSec(), "cpuSeconds": time.process_time() - self.searchStartCpu,
+                            "rootSyncs": self.rootSyncCount})
         moves = []
         for childId in self.root.children:
             child = self.getNode(childId)
-            result = {"move": child.priorMove, "avgReward": child.avgReward, "visits": child.visitCount}
+            move = child.priorMove if child.priorMove is not None else self.rootChoices[child.moveIndex]
+            result = {"move": move, "avgReward": child.avgReward, "visits": child.visitCount}
             moves.append(result)
         treeResults["moves"] = moves
+        if self.snapshotCache:
+            treeResults["snapshotCache"] = self.snapshotCache.stats()
+        if self.tree.transpositions is not None:
+            treeResults["transpositions"] = self.tree.transpositions.stats()
+        if self.profiler:
+            treeResults["stageProfile"] = self.profiler.stats()
+        treeResults["memory"] = self.collectMemoryStats()
+        treeResults["rolloutStats"] = self.rolloutStats.trim()
+        treeResults["rolloutSummary"] = self.rolloutStats.summary()
+        if self.keepTrees and not self.useSharedNodes:
+            treeResults["tree"] = self.tree
         parallelResults.append(treeResults)
 
+    def syncRootStats(self):
+        # publish this worker's shallow node statistics and take the sum of the other workers' (two Manager calls)
+        start = time.perf_counter()
+        pid = os.getpid()
+        self.rootStatsDict[pid] = self.tree.shallowNodeStats(self.rootSyncDepth)
+        externalStats = {}
+        for workerPid, workerStats in self.rootStatsDict.items():
+            if workerPid == pid:
+                continue
+            for path, (visits, reward) in workerStats.items():
+                if path in externalStats:
+                    totalVisits, totalReward = externalStats[path]
+                    externalStats[path] = (totalVisits + visits, totalReward + reward)
+                else:
+                    externalStats[path] = (visits, reward)
+        self.tree.setExternalStats(externalStats)
+        self.rootSyncCount += 1
+        if self.profiler:
+            self.profiler.add("rootSync", time.perf_counter() - start)
+
+    def aggregateRootMoves(self):
+        # root moves of all workers' trees: {move: {"visits": total visits, "avgReward": visit-weighted average}}
+        totals = {}
+        for treeResult in self.parallelResults:
+            for moveResult in treeResult["moves"] if "moves" in treeResult else []:
+                move = moveResult["move"]
+                visits, reward = totals[move] if move in totals else (0, 0)
+                totals[move] = (visits + moveResult["visits"], reward + moveResult["avgReward"] * moveResult["visits"])
+        return {move: {"visits": visits, "avgReward": round(reward / visits, 3) if visits else 0} for move, (visits, reward) in totals.items()}
+
+    def advanceRoot(self, committedMoves):
+        # receding horizon: keep the subtree of each worker's tree below committedMoves ({varName: move})
+        # so the next window's search starts with its visit and reward statistics.
+        # The tree is re-rooted at the deepest node on the committed path. A commit usually reaches further than
+        # the tree (rollouts only add one node each), and then the committed path leaves the tree at that node:
+        # its children decide a committed var, so only the node's own statistics are kept. Subtrees are only
+        # reused when the commit ends inside the tree, i.e. when the commit is short compared to the tree depth.
+        self.initialTrees = []
+        for treeResult in self.parallelResults:
+            tree = treeResult["tree"] if "tree" in treeResult else None
+            if not tree:
+                self.initialTrees.append(None)
+                continue
+            nodeId, keepChildren = tree.findCommittedNode(committedMoves)
+            subtree = tree.extractSubtree(nodeId, keepChildren)
+            self.logMsg("advanceRoot() reusing "+str(subtree.nodeCount())+" of "+str(tree.nodeCount())+" nodes, new root at depth "
+                        +str(tree.depth[nodeId] - tree.depth[1])+(" of the committed path" if keepChildren else ", where the committed path leaves the tree"))
+            self.initialTrees.append(subtree)
+
     def getMostPlayedNextMove(self):
         self.logMsg("getMostPlayedNextMove()")
         winner = None
@@ -450,23 +1042,56 @@ class DshieldPlanner:
         # pop removes last item in list
         return self.replayPlan.pop()
 
+    def resumeFromCachedAncestor(self):
+        # restart the rollout from the deepest cached node on the replay path (possibly the selected leaf itself)
+        position, snapshot = self.snapshotCache.findDeepest(self.replayPlan)
+        if snapshot is not None:
+            if self.traceRollouts:
+                self.logMsg("resumeFromCachedAncestor() skipping "+str(len(self.replayPlan) - position)+" of "+str(len(self.replayPlan))+" replay moves")
+            # the skipped moves are still part of this rollout's choice sequence (root first)
+            self.rolloutChoiceIndexes.extend(moveIndex for moveIndex, _ in reversed(self.replayPlan[position:]))
+            self.replayPlan = self.replayPlan[:position]
+            self.resumeSnapshot = snapshot
+
+    def getResumeSnapshot(self):
+        # called by the application at the start of each rollout
+        # returns application state to restore (instead of initializing it), or None
+        return self.resumeSnapshot
+
+    def choiceApplied(self):
+        # called by the application after applying each choice, so the resulting state can be cached (and hashed)
+        if not self.lastMoveNodeId:
+            return
+        start = time.perf_counter()
+        if self.snapshotCache:
+            self.snapshotCache.offer(self.lastMoveNodeId, self.tree.visitCount[self.lastMoveNodeId], self.snapshotFn)
+        if self.tree.transpositions is not None and not self.tree.hasNodeHash(self.lastMoveNodeId):
+            self.tree.setNodeHash(self.lastMoveNodeId, self.stateHashFn())
+        self.lastMoveNodeId = None
+        self.addPlannerTime("snapshot", start)
+
     def createRootNode(self):
         self.logMsg("createRootNode()")
         self.root = self.createNode()
         self.root.depth = 1
 
     def createNode(self):
+        if not self.useManagerNodes:
+            return self.tree.getNode(self.tree.createNode())
         with self.sharedNodesLock:
             node = MctsNode(self.getNextNodeId())
             node.unexploredChoices = None # set by chooseValue()
-            self.openNodes.append(node)
-            self.allNodes[node.id] = node
-            if self.useSharedNodes:
-                self.sharedNodes.append(node)
+            self.sharedNodes.append(node)
             return node
 
 
-    def createChildNode(self, parent, name, cmdChoice):
+    def createChildNode(self, parent, name, cmdChoice, moveIndex):
+        # moveIndex: position of cmdChoice in the parent's choice list (used to replay the edge)
+        if not self.useManagerNodes:
+            child = self.tree.getNode(self.tree.addChild(parent.id, name, cmdChoice, moveIndex))
+            if self.traceRollouts:
+                self.logMsg("createChildNode() child: "+str(child))
+            return child
         with self.sharedNodesLock:
             child = self.createNode()
             child.name = name
@@ -476,30 +1101,31 @@ class DshieldPlanner:
             child.unexploredChoices = None # determined at next choice point
             # mark the edge (cmdChoice) from parent
             child.priorMove = (cmdChoice)
-            self.logMsg("createChildNode() child: "+str(child))
+            child.moveIndex = moveIndex
+            if self.traceRollouts:
+                self.logMsg("createChildNode() child: "+str(child))
             if self.useSharedNodes:
                 self.updateSharedNode(child)
                 self.updateSharedNode(parent)
             return child
 
     def getNode(self, nodeId):
-        if self.useSharedNodes:
+        if self.useManagerNodes:
             with self.sharedNodesLock:
                 node = self.sharedNodes[nodeId-1]
         else:
-            node = self.allNodes[nodeId] if nodeId in self.allNodes else None
+            node = self.tree.getNode(nodeId)
         return node
 
     def getNextNodeId(self):
-        if self.useSharedNodes:
+        if self.useManagerNodes:
             with self.sharedNodesLock:
                 return len(self.sharedNodes)+1
         else:
-            self.nextNodeId += 1
-            return self.nextNodeId
+            return self.tree.size()
 
     def updateSharedNode(self, node):
-        if self.useSharedNodes:
+        if self.useManagerNodes:
             with self.sharedNodesLock:
                 id = node.id
                 priorNode = self.getNode(id)
@@ -510,14 +1136,16 @@ class DshieldPlanner:
 
 
     def setCurrentNode(self, node):
-        self.logMsg("setCurrentNode() "+str(node))
+        if self.traceRollouts:
+            self.logMsg("setCurrentNode() "+str(node))
         self.currentNode = node
 
     def getCurrentNode(self):
         return self.currentNode
 
     def printParallelResults(self):
-        self.logMsg("Best Results ("+str(len(self.parallelResults))+"):")
+        totalRolloutsPerSec = sum(treeResult["rolloutsPerSec"] for treeResult in self.parallelResults if "rolloutsPerSec" in treeResult)
+        self.logMsg("Best Results ("+str(len(self.parallelResults))+"), rollouts/sec (all workers): "+str(round(totalRolloutsPerSec, 1))+":")
         # TODO: sort results in decending objective order
         for treeResult in self.parallelResults:
             bestScore = treeResult["bestScore"]
@@ -526,13 +1154,40 @@ class DshieldPlanner:
             fullMsg = "Best score: "+str(bestScore)
             if bestScore == self.bestPlanScore:
                 fullMsg += "*"
+            if "stageProfile" in treeResult:
+                fullMsg += ", stages: "+formatStageStats(treeResult["stageProfile"])
             for dict in moves:
                 move = dict["move"]
                 avgRwd = round(dict["avgReward"],3)
                 visits = dict["visits"]
-                fullMsg += ", "+ move+": "+str(avgRwd)+ " pts/"+str(visits)+" visits"
+                fullMsg += ", "+ self.moveText(move)+": "+str(avgRwd)+ " pts/"+str(visits)+" visits"
             fullMsg +=", random %: "+str(randomPct)
+            if "rolloutsPerSec" in treeResult:
+                fullMsg += ", rollouts/sec: "+str(treeResult["rolloutsPerSec"])
+            if "stopReason" in treeResult:
+                fullMsg += ", stopped after "+str(treeResult["rollouts"])+" rollouts: "+str(treeResult["stopReason"])
+            if "rolloutSummary" in treeResult:
+                summary = treeResult["rolloutSummary"]
+                fullMsg += ", rollout ms p50/p95/p99: "+str(summary.get("p50ms"))+"/"+str(summary.get("p95ms"))+"/"+str(summary.get("p99ms"))
+            if "snapshotCache" in treeResult:
+                fullMsg += ", snapshot cache: "+str(treeResult["snapshotCache"])
+            if "transpositions" in treeResult:
+                fullMsg += ", transpositions: "+str(treeResult["transpositions"])
+            if "memory" in treeResult:
+                fullMsg += ", memory: "+str(treeResult["memory"])
             self.logMsg(fullMsg)
+        self.logStopReasons()
+        rootMoves = self.aggregateRootMoves()
+        if rootMoves:
+            self.logMsg("Root moves (all workers): "+", ".join(self.moveText(move)+": "+str(stats["avgReward"])+" pts/"+str(stats["visits"])+" visits" for move, stats in rootMoves.items()))
+        stageProfile = self.getStageProfile()
+        if stageProfile:
+            self.logMsg("Stage times (all workers): "+formatStageStats(stageProfile))
+
+    def getStageProfile(self):
+        # per-stage times and call counts of all workers, merged
+        profiles = [treeResult["stageProfile"] for treeResult in self.parallelResults if "stageProfile" in treeResult]
+        return StageProfiler.merge(profiles) if profiles else None
 
     def printPathFromRoot(self, node):
         path = [node]
@@ -545,54 +1200,26 @@ class DshieldPlanner:
 
     def printTree(self):
         with self.sharedNodesLock:
-            root = self.sharedNodes[0] if self.sharedNodes else self.root
-            print("\n-----------\n"+str(self.printTreeRecursive(root, 0))+"\n")
+            root = self.sharedNodes[0] if self.useManagerNodes and self.sharedNodes else self.root
+            print("\n-----------\n"+str(self.treeToString(root))+"\n")
 
-    def printTreeRecursive(self, node, level):
-        # RECURSIVE
+    def treeToString(self, node):
+        # depth-first walk with an explicit stack (deep trees exceed the recursion limit)
         if node is None:
             # find root
             node = self.root
-        if node:
-            msg = "\n"
-            if level == 0:
-                msg = "[root]\n"
-                level += 1
-            for i in range(level):
-                msg += "  "
-            msg += str(node)
-            for childId in node.children:
-                child = self.getNode(childId)
-                # RECURSIVE !!!
-                msg += self.printTreeRecursive(child, level + 1)
-            return msg
-        else:
+        if not node:
             print("printTree() *** ERROR *** root not found!")
-
-    # def printSharedTree(self):
-    #     root = self.sharedNodes[0]
-    #     print("\n-----------\n"+str(self.printSharedTreeRecursive(root, 0))+"\n")
-    #
-    # def printTreeRecursive(self, node, level):
-    #     # RECURSIVE
-    #     if node is None:
-    #         # find root
-    #         node = self.root
-    #     if node:
-    #         msg = "\n"
-    #         if level == 0:
-    #             msg = "[root]\n"
-    #             level += 1
-    #         for i in range(level):
-    #             msg += "  "
-    #         msg += str(node)
-    #         for childId in node.children:
-    #             child = self.getNode(childId)
-    #             # RECURSIVE !!!
-    #             msg += self.printTreeRecursive(child, level + 1)
-    #         return msg
-    #     else:
-    #         print("printTree() *** ERROR *** root not found!")
+            return None
+        lines = ["[root]"]
+        stack = [(node, 1)]
+        while stack:
+            node, level = stack.pop()
+            lines.append("  " * level + str(node))
+            children = [self.getNode(childId) for childId in node.children]
+            for child in reversed(children):
+                stack.append((child, level + 1))
+        return "\n".join(lines)
 
     def printNodePlan(self, node):
         path = [node]
@@ -607,7 +1234,8 @@ class DshieldPlanner:
 
     def setStage(self, stage):
         self.stage = stage
-        self.logMsg("Stage = "+self.stage)
+        if self.traceRollouts:
+            self.logMsg("Stage = "+self.stage)
 
     def initStats(self):
         self.stats["startTime"] = time.localtime()
@@ -615,17 +1243,16 @@ class DshieldPlanner:
         self.stats["timerStart"] = time.time()
 
 
-    def stopRolloutStats(self, rolloutStart, rolloutNumber):
-        elapsedMinutes, elapsedSecs = divmod(time.time() - rolloutStart, 60)
-        elapsedHours, elapsedMinutes = divmod(elapsedMinutes, 60)
-        elapsedString = ""
-        if elapsedHours:
-            elapsedString += str(elapsedHours)+ " h, "
-        if elapsedMinutes:
-            elapsedString += str(int(elapsedMinutes)) + " m, "
-        elapsedString += format(elapsedSecs, '.3f')+" s"
-        self.logMsg("Rollout duration: "+elapsedString)
-        self.rolloutStats[rolloutNumber] = {"time": elapsedString}
+    def stopRolloutStats(self, rolloutStart, score):
+        duration = time.time() - rolloutStart
+        if self.traceRollouts:
+            self.logMsg("Rollout duration: "+format(duration, '.3f')+" s")
+        depth = self.currentNode.depth if self.currentNode else 1
+        self.rolloutStats.record(rolloutStart - self.searchStartTime, duration, depth, self.rolloutChoiceCount, score)
+
+    def getRolloutStats(self):
+        # rollout stats of all workers (after the search), merged
+        return RolloutStats.merge([treeResult["rolloutStats"] for treeResult in self.parallelResults if "rolloutStats" in treeResult])
 
     def printStats(self):
         self.stats["timerEnd"] = time.time()
@@ -641,33 +1268,51 @@ class DshieldPlanner:
         elapsedString += format(elapsedSecs, '.3f')+" s"
         self.stats["elapsed"] = elapsedString
         print("\nTime: "+self.stats["startTimestamp"]+"-"+self.stats["endTimestamp"]+", elapsed: "+elapsedString)
-        print("loop limit: "+str(self.rolloutLimit))
+        print("loop limit: "+str(self.rolloutLimit)+", time limit: "+str(self.plannerTimeLimitSeconds))
 
     def collectMemoryStats(self):
-        # NOT USED
-        ramUsed = str(round(psutil.virtual_memory()[3]/1000000000, 3))+" GB"
-        currentMem, peakMem = tracemalloc.get_traced_memory()
-        currentMem = round(currentMem/(1024*1024), 3) # MB
+        # RSS of this process (peak over the samples taken by enforceMemoryBudget) and tree size
+        rssMB = round(psutil.Process().memory_info().rss / 1000000, 1)
+        self.peakRssMB = max(self.peakRssMB, rssMB)
+        return {"rssMB": rssMB, "peakRssMB": self.peakRssMB, "treeNodes": self.tree.nodeCount(), "treeMB": round(self.tree.memoryBytes() / 1000000, 3),
+                "prunes": self.pruneCount, "prunedNodes": self.prunedNodeCount}
+
+    def enforceMemoryBudget(self, rolloutCount):
+        # called after each rollout by mcts()
+        if self.maxTreeNodes and self.tree.nodeCount() >= self.maxTreeNodes:
+            self.pruneTree("node budget")
+        elif self.memoryBudgetMB and rolloutCount % self.memoryCheckInterval == 0:
+            if self.collectMemoryStats()["rssMB"] >= self.memoryBudgetMB:
+                # freed memory is not always returned to the OS, so from now on keep the tree below its current size
+                self.maxTreeNodes = self.tree.nodeCount()
+                self.pruneTree("memory budget")
+
+    def pruneTree(self, reason):
+        nodeCount = self.tree.nodeCount()
+        self.tree, idMap = self.tree.pruneToSize(max(int(nodeCount * self.pruneKeepFraction), 1))
+        self.root = self.tree.getNode(1)
+        self.bestPlanNode = None # view of a node in the old tree
+        if self.snapshotCache:
+            self.snapshotCache.clear() # snapshots are keyed by old node ids
+        self.pruneCount += 1
+        self.prunedNodeCount += nodeCount - len(idMap)
+        self.logMsg("pruneTree() "+reason+": kept "+str(len(idMap))+" of "+str(nodeCount)+" nodes")
 
     def writeDebugFiles(self, filepath):
         # filename = filepath + "/searchTree.txt"
         # print("Writing debug file: MCTS search tree")
-        # treeString = self.printTreeRecursive(self.root, 0)
+        # treeString = self.treeToString(self.root)
         # with open(filename, "w") as f:
         #     f.write(time.strftime("%m/%d/%Y %H:%M:%S", currentTime)+"\n\nMCTS Search Tree\n")
         #     f.write("\n"+str(treeString))
         currentTime = time.localtime()
-        filename = "/rolloutStats.txt"
-        filename = filepath + filename
-        print("Writing debug file: rollout stats")
-        with open(filename, "w") as f:
+        rolloutStats = self.getRolloutStats()
+        print("Writing debug files: rollout stats")
+        rolloutStats.write(filepath + "/rolloutStats.bin") # raw per-rollout data, see RolloutStats.read()
+        with open(filepath + "/rolloutStats.txt", "w") as f:
             f.write(time.strftime("%m/%d/%Y %H:%M:%S", currentTime)+"\n\n"+str(self.rolloutLimit)+ " rollouts\n\n")
-            rolloutKeys = sorted(list(self.rolloutStats.keys()))
-            for rollout in rolloutKeys:
-                rolloutDuration = self.rolloutStats[rollout]["time"]
-                msg = str(rollout)+": "+rolloutDuration
-                msg += "\n"
-                f.write(msg)
+            for key, value in rolloutStats.summary().items():
+                f.write(key+": "+str(value)+"\n")
 
     def roundIt(self, n, precision=3):
         return round(n, precision)
@@ -694,12 +1339,40 @@ class DshieldPlanner:
 
 
     def logMessage(self, msg):
+        if self.logBackend == "files":
+            self.getLogSink().write(msg)
+            return
+        if self.logBackend == "stdout":
+            print(msg)
+            return
         with self.logLock:
             self.loggerQ.put(msg)
 
+    def initLogDir(self):
+        # remove the per-process files of a previous run
+        os.makedirs(self.logDir, exist_ok=True)
+        for name in os.listdir(self.logDir):
+            if name.endswith(".log") and name[:-4].isdigit():
+                os.remove(os.path.join(self.logDir, name))
+
+    def getLogSink(self):
+        # one sink per process: a forked worker starts its own instead of sharing its parent's buffer
+        if not self.logSink or self.logSink.pid != os.getpid():
+            self.logSink = LogSink(self.logDir)
+        return self.logSink
+
+    def flushLog(self):
+        # called by each process before it exits (forked processes skip atexit handlers)
+        if self.logSink and self.logSink.pid == os.getpid():
+            self.logSink.flush()
+
+    def mergeLogs(self):
+        # merge the per-process log files by timestamp, returns the merged file path
+        return mergeLogs(self.logDir, os.path.join(self.logDir, "merged.log"))
+
     def logMsg(self, msg, includeBlankLine = False):
-        # if not self.loggingEnabled:
-        #     return
+        if self.logLevel > LOG_LEVELS["info"]:
+            return
         sup = self.planner
         if sup:
             sup.logMsg(msg, includeBlankLine)
@@ -149,11 +149,16 @@ class FileUtil:
         if filtered:
             filename += "filtered."
         filename += "txt"
-        vars = self.planner.initialPlanVars if filtered else self.planner.allPlanVars
+        app = self.planner
+        vars = app.initialPlanVars if filtered else app.allPlanVars
         with open(filename, "w") as f:
             f.write("Var count: "+str(len(vars))+"\n\n")
-            for var in vars:
-                f.write(str(var)+"\n")
+            if filtered:
+                for varId, domain in vars:
+                    f.write(str((app.varNames[varId], [app.cmdText(cmdId) for cmdId in domain]))+"\n")
+            else:
+                for varId in vars:
+                    f.write(app.varNames[varId]+"\n")
 
     def writeResultFiles(self):
         print("Writing result files")
@@ -179,7 +184,7 @@ class FileUtil:
         print("\n\nBest Plan Node:\n"+str(bestPlanNode))
         filepath = self.planner.experimentDataPath + "planner/"+self.planner.experimentRun
         for sat in self.planner.satList:
-            plan = self.planner.bestPlan["plan"][sat]
+            plan = self.planner.planText(self.planner.bestPlan["plan"][sat], bestPlanState[sat]["images"])
             filename = "/bestPlan."+sat+"."
             if verbose:
                 filename += "Details"
@@ -0,0 +1,66 @@
+import heapq
+import os
+import sys
+import time
+
+
+class LogSink:
+    # Per-process log backend used in place of the shared loggerQ: each process buffers its
+    # records in memory and appends them in batches to its own file (<logDir>/<pid>.log),
+    # so workers never wait on the logger process or the manager lock.
+    # Records are "<timestamp>\t<message>" lines; mergeLogs() interleaves the files by timestamp.
+
+    def __init__(self, logDir, batchSize=1000):
+        self.logDir = logDir
+        self.batchSize = batchSize
+        self.pid = os.getpid()
+        self.path = os.path.join(logDir, str(self.pid)+".log")
+        self.records = []
+
+    def write(self, msg):
+        self.records.append((time.time(), msg))
+        if len(self.records) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        with open(self.path, "a") as f:
+            for timestamp, msg in self.records:
+                # keep one record per line (messages may contain newlines)
+                f.write(format(timestamp, ".6f")+"\t"+msg.replace("\n", "\\n")+"\n")
+        self.records = []
+
+
+def readLogRecords(path):
+    with open(path, "r") as f:
+        for line in f:
+            timestamp, msg = line.rstrip("\n").split("\t", 1)
+            yield float(timestamp), msg.replace("\\n", "\n")
+
+
+def mergeLogs(logDir, outPath=None):
+    # merge the per-process log files in logDir by timestamp (each file is already in time order)
+    # writes to outPath if given, otherwise returns the merged messages
+    paths = [os.path.join(logDir, name) for name in sorted(os.listdir(logDir)) if name.endswith(".log") and name[:-4].isdigit()]
+    merged = heapq.merge(*[readLogRecords(path) for path in paths], key=lambda record: record[0])
+    if not outPath:
+        return [msg for _, msg in merged]
+    with open(outPath, "w") as f:
+        for _, msg in merged:
+            f.write(msg+"\n")
+    return outPath
+
+
+def main():
+    # offline merge: python logSink.py <logDir> [outPath]
+    logDir = sys.argv[1]
+    outPath = sys.argv[2] if len(sys.argv) > 2 else None
+    if outPath:
+        print("Merged logs written to "+mergeLogs(logDir, outPath))
+    else:
+        for msg in mergeLogs(logDir):
+            print(msg)
+
+if __name__ == '__main__':
+    main()
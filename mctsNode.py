@@ -11,6 +11,7 @@ class MctsNode:
         self.avgReward = 0 # totalReward/visitCount
         self.status = "init"
         self.priorMove = None
+        self.moveIndex = None # position of priorMove in the parent's choice list
         self.unexploredChoices = None
         self.planScore = None # set by application code
         self.depth = 0
@@ -25,14 +26,24 @@ class MctsNode:
             return True
         return self.unexploredChoices and len(self.unexploredChoices) > 0
 
+    def setChoices(self, choices):
+        self.unexploredChoices = copy.copy(choices)  # TODO: is this copy required?
+        self.status = "open"
+
+    def getUnexploredChoices(self, choices):
+        return self.unexploredChoices
+
+    def removeUnexploredChoice(self, choice, choices):
+        self.unexploredChoices.remove(choice)
+
     def __str__(self):
         totalReward = str(round(self.totalReward, 3))
         avgReward = str(round(self.avgReward,3))
         msg = "["+str(self.id)
-        if self.name:
+        if self.name != "":
             msg += ": "+str(self.name)
         msg +=", parent: "+str(self.parent)
-        if self.priorMove:
+        if self.priorMove is not None:
             msg += ", move: "+str(self.priorMove)
         msg += ", unexploredChoices: "+str(self.unexploredChoices)
         if self.planScore:
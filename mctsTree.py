@@ -0,0 +1,489 @@
+import heapq
+import math
+
+from array import array
+
+# Node status codes (stored in the status column)
+INIT = 0
+OPEN = 1
+EXHAUSTED = 2
+STATUS_NAMES = ("init", "open", "exhausted")
+STATUS_CODES = {"init": INIT, "open": OPEN, "exhausted": EXHAUSTED}
+
+NULL_NODE = 0    # node ids start at 1, so 0 marks "no parent/child/sibling"
+MAX_CHOICES = 64 # one bit per choice in the exploredMask column
+UCT_C = math.sqrt(2) # UCT exploration constant
+
+# (column name, array typecode, initial value), widest types first so column offsets stay aligned
+COLUMNS = (
+    ("parent",       "q", NULL_NODE),
+    ("firstChild",   "q", NULL_NODE),
+    ("lastChild",    "q", NULL_NODE),
+    ("nextSibling",  "q", NULL_NODE),
+    ("visitCount",   "q", 0),
+    ("totalReward",  "d", 0.0),
+    ("exploredMask", "Q", 0),   # bit i set once choice i has been expanded
+    ("depth",        "i", 0),
+    ("moveId",       "i", -1),  # interned priorMove (edge label from parent)
+    ("nameId",       "i", -1),  # interned varName of the parent's choice point
+    ("moveIndex",    "h", -1),  # position of priorMove in the parent's choice list (used by replay)
+    ("choiceCount",  "h", 0),   # set on the node's first visit
+    ("status",       "b", INIT),
+)
+
+
+class MctsTree:
+    # Struct-of-arrays MCTS tree used in place of one MctsNode object per node.
+    # A node is an integer id which indexes parallel columns. Children are kept as a
+    # first-child/next-sibling list (lastChild keeps them in insertion order).
+    # Move and variable name strings are interned once and stored as small ints.
+    # Unexplored choices are not copied into each node: the node only records how many
+    # choices it has and a bitmask of the ones already expanded. The choice list itself
+    # is supplied again by the application whenever the node is revisited.
+
+    def __init__(self):
+        for name, typecode, initialValue in COLUMNS:
+            setattr(self, name, array(typecode, [initialValue]))  # slot 0 is the null node
+
+        self.moves = []    # moveId -> move string
+        self.moveIds = {}  # move string -> moveId
+        self.names = []    # nameId -> varName
+        self.nameIds = {}  # varName -> nameId
+        self.planScores = {}  # sparse {nodeId: score}, set by application code
+        self.transpositions = None # optional TranspositionTable shared by nodes with the same state hash
+        self.nodeHashes = {}  # sparse {nodeId: state hash}, only used with a transposition table
+        self.externalStats = {}  # sparse {nodeId: (visits, total reward)} of the same node in other workers' trees
+
+    # NODE CREATION
+
+    def newNodeId(self):
+        # append a blank slot to every column and return its id
+        for name, typecode, initialValue in COLUMNS:
+            getattr(self, name).append(initialValue)
+        return len(self.parent) - 1
+
+    def createNode(self):
+        return self.newNodeId()
+
+    def addChild(self, parentId, name, move, moveIndex):
+        childId = self.newNodeId()
+        self.parent[childId] = parentId
+        self.depth[childId] = self.depth[parentId] + 1
+        self.nameId[childId] = self.intern(name, self.names, self.nameIds)
+        self.moveId[childId] = self.intern(move, self.moves, self.moveIds)
+        self.moveIndex[childId] = moveIndex
+        self.linkChild(parentId, childId)
+        return childId
+
+    def linkChild(self, parentId, childId):
+        # append childId to the parent's child list (child slot must already be filled in)
+        lastChild = self.lastChild[parentId]
+        if lastChild:
+            self.nextSibling[lastChild] = childId
+        else:
+            self.firstChild[parentId] = childId
+        self.lastChild[parentId] = childId
+
+    def intern(self, value, values, valueIds):
+        if value is None:
+            return -1
+        valueId = valueIds.get(value)
+        if valueId is None:
+            valueId = len(values)
+            values.append(value)
+            valueIds[value] = valueId
+        return valueId
+
+    # NODE ACCESS
+
+    def getNode(self, nodeId):
+        if 0 < nodeId < self.size():
+            return MctsTreeNode(self, nodeId)
+        return None
+
+    def size(self):
+        # number of slots including the null node
+        return len(self.parent)
+
+    def nodeCount(self):
+        return self.size() - 1
+
+    def children(self, nodeId):
+        result = []
+        childId = self.firstChild[nodeId]
+        while childId:
+            result.append(childId)
+            childId = self.nextSibling[childId]
+        return result
+
+    def hasChildren(self, nodeId):
+        return self.firstChild[nodeId] != NULL_NODE
+
+    def unexploredCount(self, nodeId):
+        return self.choiceCount[nodeId] - bin(self.exploredMask[nodeId]).count("1")
+
+    def isLeaf(self, nodeId):
+        # True if node has unexplored choices (or choices have not been initialized)
+        if self.status[nodeId] == INIT:
+            return True
+        return self.unexploredCount(nodeId) > 0
+
+    def avgReward(self, nodeId):
+        visits = self.visitCount[nodeId]
+        return self.totalReward[nodeId] / visits if visits else 0
+
+    def getPriorMove(self, nodeId):
+        moveId = self.moveId[nodeId]
+        return self.moves[moveId] if moveId >= 0 else None
+
+    def getName(self, nodeId):
+        nameId = self.nameId[nodeId]
+        return self.names[nameId] if nameId >= 0 else ""
+
+    # SELECTION
+
+    def bestChild(self, nodeId):
+        # rank-normalized UCT in one pass over the node's children, without sorting or dicts
+        # (choice points have 2-3 choices). A child's rank is 1 + the number of siblings with a lower
+        # average reward (an earlier sibling ranks lower on ties), normalized by the rank total k(k+1)/2.
+        # Unvisited nodes count as visited once; the visit counts themselves are not changed.
+        visitCount = self.visitCount
+        totalReward = self.totalReward
+        nextSibling = self.nextSibling
+        externalStats = self.externalStats
+        childIds = []
+        childVisits = []
+        avgRewards = []
+        childId = self.firstChild[nodeId]
+        while childId:
+            visits = visitCount[childId]
+            reward = totalReward[childId]
+            if self.transpositions is not None and childId in self.nodeHashes:
+                entry = self.transpositions.get(self.nodeHashes[childId])
+                if entry:
+                    visits, reward = entry
+            if externalStats and childId in externalStats:
+                externalVisits, externalReward = externalStats[childId]
+                visits += externalVisits
+                reward += externalReward
+            childIds.append(childId)
+            childVisits.append(visits)
+            avgRewards.append(reward / visits if visits else 0)
+            childId = nextSibling[childId]
+        count = len(childIds)
+        if not count:
+            return NULL_NODE
+        rankTotal = count * (count + 1) / 2
+        parentVisitCount = visitCount[nodeId] + (externalStats[nodeId][0] if nodeId in externalStats else 0)
+        parentVisits = 2 * math.log(max(parentVisitCount, 1))
+        bestId = NULL_NODE
+        bestScore = None
+        bestRank = None
+        for i in range(count):
+            avgReward = avgRewards[i]
+            rank = 1
+            for j in range(count):
+                if avgRewards[j] < avgReward or (j < i and avgRewards[j] == avgReward):
+                    rank += 1
+            childId = childIds[i]
+            score = rank / rankTotal + UCT_C * math.sqrt(parentVisits / max(childVisits[i], 1))
+            if bestScore is None or score > bestScore or (score == bestScore and rank < bestRank):
+                bestId, bestScore, bestRank = childId, score, rank
+        return bestId
+
+    def selectLeaf(self, nodeId):
+        # descend from nodeId by bestChild() until a node with unexplored choices (or no children) is reached
+        while self.firstChild[nodeId] and not self.isLeaf(nodeId):
+            nodeId = self.bestChild(nodeId)
+        return nodeId
+
+    # ROOT STATISTICS SYNCHRONIZATION (independent trees of parallel workers)
+
+    def shallowNodeStats(self, maxDepth):
+        # {path of move indexes from the root: (visits, total reward)} for the root and the nodes at most maxDepth moves below it
+        # (this tree's own statistics; paths identify the same node in every worker's tree)
+        stats = {}
+        queue = [(1, ())]
+        while queue:
+            nodeId, path = queue.pop()
+            stats[path] = (self.visitCount[nodeId], self.totalReward[nodeId])
+            if len(path) < maxDepth:
+                childId = self.firstChild[nodeId]
+                while childId:
+                    queue.append((childId, path + (self.moveIndex[childId],)))
+                    childId = self.nextSibling[childId]
+        return stats
+
+    def setExternalStats(self, pathStats):
+        # pathStats: other workers' shallowNodeStats() summed by path; nodes this tree has not expanded yet are skipped
+        self.externalStats = {}
+        maxDepth = max(len(path) for path in pathStats) if pathStats else 0
+        queue = [(1, ())]
+        while queue:
+            nodeId, path = queue.pop()
+            if path in pathStats:
+                self.externalStats[nodeId] = pathStats[path]
+            if len(path) < maxDepth:
+                childId = self.firstChild[nodeId]
+                while childId:
+                    queue.append((childId, path + (self.moveIndex[childId],)))
+                    childId = self.nextSibling[childId]
+
+    # CHOICES
+
+    def setChoices(self, nodeId, choiceCount):
+        # no-op once set (another worker may have set and started expanding a shared node)
+        assert choiceCount <= MAX_CHOICES, "MctsTree.setChoices() ERROR! too many choices: "+str(choiceCount)
+        if self.status[nodeId] != INIT:
+            return
+        self.choiceCount[nodeId] = choiceCount
+        self.exploredMask[nodeId] = 0
+        self.status[nodeId] = OPEN
+
+    def getUnexploredChoices(self, nodeId, choices):
+        # filter the node's (re-supplied) choice list down to the choices not yet expanded
+        mask = self.exploredMask[nodeId]
+        count = min(self.choiceCount[nodeId], len(choices))
+        return [choices[i] for i in range(count) if not mask & (1 << i)]
+
+    def markExplored(self, nodeId, choiceIndex):
+        self.exploredMask[nodeId] |= (1 << choiceIndex)
+        if self.unexploredCount(nodeId) <= 0:
+            self.status[nodeId] = EXHAUSTED
+
+    # STATISTICS
+
+    def backpropagate(self, nodeId, leafReward, reward):
+        # add leafReward to the node and reward to each of its ancestors
+        self.visitCount[nodeId] += 1
+        self.totalReward[nodeId] += leafReward
+        if self.transpositions is not None:
+            self.backpropagateTranspositions(nodeId, leafReward, reward)
+        nodeId = self.parent[nodeId]
+        while nodeId:
+            self.visitCount[nodeId] += 1
+            self.totalReward[nodeId] += reward
+            nodeId = self.parent[nodeId]
+
+    # TRANSPOSITIONS
+
+    def hasNodeHash(self, nodeId):
+        return nodeId in self.nodeHashes
+
+    def setNodeHash(self, nodeId, stateHash):
+        self.nodeHashes[nodeId] = stateHash
+        self.transpositions.register(stateHash)
+
+    def backpropagateTranspositions(self, nodeId, leafReward, reward):
+        nodeHashes = self.nodeHashes
+        if nodeId in nodeHashes:
+            self.transpositions.add(nodeHashes[nodeId], leafReward)
+        nodeId = self.parent[nodeId]
+        while nodeId:
+            if nodeId in nodeHashes:
+                self.transpositions.add(nodeHashes[nodeId], reward)
+            nodeId = self.parent[nodeId]
+
+    def pathMoves(self, nodeId):
+        # replay plan: (priorMove index, node id) from nodeId up to (not including) the root, deepest move first
+        moves = []
+        parentId = self.parent[nodeId]
+        while parentId:
+            moves.append((self.moveIndex[nodeId], nodeId))
+            nodeId = parentId
+            parentId = self.parent[nodeId]
+        return moves
+
+    # SUBTREE REUSE
+
+    def findCommittedNode(self, committedMoves):
+        # follow committedMoves ({varName: move}) down from the root
+        # returns (deepest node reached, True if its children lie beyond the committed moves). When the committed
+        # path leaves the tree (its next move was never expanded, or the node has no children) the node's choice
+        # point is committed too, so only the node's own statistics still apply and its children must be dropped.
+        nodeId = 1
+        while True:
+            childId = self.firstChild[nodeId]
+            if not childId:
+                return nodeId, False # choice point of this node is unknown
+            name = self.getName(childId)
+            if name not in committedMoves:
+                return nodeId, True
+            move = committedMoves[name]
+            while childId and self.getPriorMove(childId) != move:
+                childId = self.nextSibling[childId]
+            if not childId:
+                return nodeId, False
+            nodeId = childId
+
+    def extractSubtree(self, rootId, keepChildren=True):
+        # copy the subtree below rootId into a new MctsTree whose root (id 1) keeps rootId's statistics;
+        # without keepChildren only the root is copied, with its choices reset to be set again on the next visit
+        subtree = type(self)()
+        newRootId = subtree.createNode()
+        subtree.depth[newRootId] = 1
+        self.copyNodeStats(rootId, subtree, newRootId)
+        if not keepChildren:
+            subtree.choiceCount[newRootId] = 0
+            subtree.exploredMask[newRootId] = 0
+            subtree.status[newRootId] = INIT
+            return subtree
+        queue = [(rootId, newRootId)]
+        while queue:
+            nodeId, newId = queue.pop()
+            childId = self.firstChild[nodeId]
+            while childId:
+                newChildId = subtree.addChild(newId, self.getName(childId), self.getPriorMove(childId), self.moveIndex[childId])
+                self.copyNodeStats(childId, subtree, newChildId)
+                queue.append((childId, newChildId))
+                childId = self.nextSibling[childId]
+        return subtree
+
+    def copyNodeStats(self, nodeId, tree, newId):
+        tree.visitCount[newId] = self.visitCount[nodeId]
+        tree.totalReward[newId] = self.totalReward[nodeId]
+        tree.choiceCount[newId] = self.choiceCount[nodeId]
+        tree.exploredMask[newId] = self.exploredMask[nodeId]
+        tree.status[newId] = self.status[nodeId]
+        if nodeId in self.planScores:
+            tree.planScores[newId] = self.planScores[nodeId]
+
+    def pruneToSize(self, keepCount):
+        # copy the keepCount most visited nodes which form a subtree containing the root (best-first from the root)
+        # into a new MctsTree; returns (new tree, {old id: new id}). Cold subtrees are dropped, and the kept parent
+        # of a dropped child gets that choice back as unexplored so it can be expanded again.
+        prunedTree = type(self)()
+        rootId = prunedTree.createNode()
+        prunedTree.depth[rootId] = self.depth[1]
+        self.copyNodeStats(1, prunedTree, rootId)
+        idMap = {1: rootId}
+        heap = [(-self.visitCount[childId], childId) for childId in self.children(1)]
+        heapq.heapify(heap)
+        while heap and len(idMap) < keepCount:
+            _, nodeId = heapq.heappop(heap)
+            newId = prunedTree.addChild(idMap[self.parent[nodeId]], self.getName(nodeId), self.getPriorMove(nodeId), self.moveIndex[nodeId])
+            self.copyNodeStats(nodeId, prunedTree, newId)
+            idMap[nodeId] = newId
+            for childId in self.children(nodeId):
+                heapq.heappush(heap, (-self.visitCount[childId], childId))
+        for nodeId, newId in idMap.items():
+            childId = self.firstChild[nodeId]
+            while childId:
+                if childId not in idMap:
+                    prunedTree.exploredMask[newId] &= ~(1 << self.moveIndex[childId])
+                    prunedTree.status[newId] = OPEN
+                childId = self.nextSibling[childId]
+        prunedTree.transpositions = self.transpositions
+        prunedTree.nodeHashes = {idMap[nodeId]: stateHash for nodeId, stateHash in self.nodeHashes.items() if nodeId in idMap}
+        return prunedTree, idMap
+
+    def memoryBytes(self):
+        return sum(getattr(self, name).itemsize * self.size() for name, _, _ in COLUMNS)
+
+
+class MctsTreeNode:
+    # Lightweight view of one MctsTree node with the same attributes as MctsNode,
+    # so that planner code can treat both kinds of node alike. Reads and writes go
+    # straight to the tree's columns.
+    __slots__ = ("tree", "id")
+
+    def __init__(self, tree, nodeId):
+        self.tree = tree
+        self.id = nodeId
+
+    @property
+    def name(self):
+        return self.tree.getName(self.id)
+
+    @property
+    def parent(self):
+        parentId = self.tree.parent[self.id]
+        return parentId if parentId else None
+
+    @property
+    def children(self):
+        return self.tree.children(self.id)
+
+    @property
+    def visitCount(self):
+        return self.tree.visitCount[self.id]
+
+    @visitCount.setter
+    def visitCount(self, value):
+        self.tree.visitCount[self.id] = value
+
+    @property
+    def totalReward(self):
+        return self.tree.totalReward[self.id]
+
+    @totalReward.setter
+    def totalReward(self, value):
+        self.tree.totalReward[self.id] = value
+
+    @property
+    def avgReward(self):
+        return self.tree.avgReward(self.id)
+
+    @property
+    def status(self):
+        return STATUS_NAMES[self.tree.status[self.id]]
+
+    @status.setter
+    def status(self, value):
+        self.tree.status[self.id] = STATUS_CODES[value]
+
+    @property
+    def priorMove(self):
+        return self.tree.getPriorMove(self.id)
+
+    @property
+    def moveIndex(self):
+        return self.tree.moveIndex[self.id]
+
+    @property
+    def depth(self):
+        return self.tree.depth[self.id]
+
+    @depth.setter
+    def depth(self, value):
+        self.tree.depth[self.id] = value
+
+    @property
+    def planScore(self):
+        return self.tree.planScores.get(self.id)
+
+    @planScore.setter
+    def planScore(self, value):
+        self.tree.planScores[self.id] = value
+
+    def hasChildren(self):
+        return self.tree.hasChildren(self.id)
+
+    def isLeaf(self):
+        return self.tree.isLeaf(self.id)
+
+    def setChoices(self, choices):
+        self.tree.setChoices(self.id, len(choices))
+
+    def getUnexploredChoices(self, choices):
+        return self.tree.getUnexploredChoices(self.id, choices)
+
+    def removeUnexploredChoice(self, choice, choices):
+        self.tree.markExplored(self.id, choices.index(choice))
+
+    def __str__(self):
+        totalReward = str(round(self.totalReward, 3))
+        avgReward = str(round(self.avgReward, 3))
+        msg = "["+str(self.id)
+        if self.name != "":
+            msg += ": "+str(self.name)
+        msg +=", parent: "+str(self.parent)
+        if self.priorMove is not None:
+            msg += ", move: "+str(self.priorMove)
+        msg += ", unexplored: "+str(self.tree.unexploredCount(self.id))+"/"+str(self.tree.choiceCount[self.id])
+        if self.planScore:
+            msg += ", score: "+str(self.planScore)
+        msg += ", avgReward: " +avgReward +" ("+totalReward+"/"+str(self.visitCount)+")"
+        msg += ", depth: "+str(self.depth)+", "+self.status
+        msg += "]"
+        return msg
@@ -0,0 +1,169 @@
+import random
+import time
+
+from dshieldPlanner import DshieldPlanner
+
+
+class SyntheticPlanningApp:
+    # Stand-in for DshieldFireApp with the same shape of search (a fixed sequence of
+    # RAW/DNL/IDL choice points per satellite with a storage model), but no input files.
+    # Used to benchmark planner modes against each other.
+
+    def __init__(self, varCount=300, satCount=4, seed=11):
+        rng = random.Random(seed)
+        self.varNames = ["SAT"+str(i % satCount)+"."+str(i) for i in range(varCount)]
+        self.values = [round(rng.random(), 3) for i in range(varCount)]
+        self.satCount = satCount
+        self.state = {}
+        self.planner = None
+
+    def plannerSettings(self, rolloutLimit, processCount):
+        return {"objective": self.updatePlanScore, "rolloutLimit": rolloutLimit, "processCount": processCount, "greedy": False, "allGreedy": False}
+
+    def createPlan(self):
+        # application code run by the planner on each rollout
+        self.state = {"storage": [0] * self.satCount, "score": 0, "plan": []}
+        for i, varName in enumerate(self.varNames):
+            sat = i % self.satCount
+            if self.state["storage"][sat] >= 3:
+                choices = ["DNL."+str(i), "IDL"]
+            else:
+                choices = ["RAW."+str(i), "IDL"]
+            cmd = self.planner.chooseValue({"varName": varName, "choices": choices}, "random")
+            if cmd.startswith("RAW"):
+                self.state["storage"][sat] += 1
+                self.state["score"] += self.values[i] / 2
+            elif cmd.startswith("DNL"):
+                self.state["storage"][sat] -= 1
+                self.state["score"] += self.values[i]
+            self.state["plan"].append((varName, cmd))
+
+    def updatePlanScore(self):
+        return round(self.state["score"], 3), self.state
+
+
+def createPlanner(app, rolloutLimit, processCount, extraSettings=None, silenceLog=True):
+    settings = app.plannerSettings(rolloutLimit, processCount)
+    if extraSettings:
+        settings.update(extraSettings)
+    planner = DshieldPlanner(settings)
+    if silenceLog:
+        planner.logMsg = lambda msg, includeBlankLine=False: None  # benchmark the search, not the logger
+    app.planner = planner
+    return planner
+
+
+def runPlanner(planner, app):
+    # returns (rollouts/sec summed over workers, best score, wall-clock seconds)
+    startTime = time.time()
+    planner.start(app.createPlan)
+    wallSeconds = time.time() - startTime
+    rolloutsPerSec = 0
+    bestScore = 0
+    for treeResult in planner.parallelResults:
+        rolloutsPerSec += treeResult["rollouts"] / treeResult["searchSeconds"]
+        bestScore = max(bestScore, treeResult["bestScore"])
+    return rolloutsPerSec, bestScore, wallSeconds
+
+
+def benchmarkSharedNodeBackends(rolloutLimit=500, processCount=4):
+    # shared-tree mode: Manager list proxy vs. shared_memory tree
+    results = []
+    for backend in ["manager", "sharedMemory"]:
+        app = SyntheticPlanningApp()
+        planner = createPlanner(app, rolloutLimit, processCount, {"sharedNodeBackend": backend})
+        planner.useSharedNodes = True
+        results.append((backend,) + runPlanner(planner, app))
+    print("\nShared tree backends ("+str(processCount)+" processes x "+str(rolloutLimit)+" rollouts)")
+    for backend, rolloutsPerSec, bestScore, wallSeconds in results:
+        print("  "+backend.ljust(14)+str(round(rolloutsPerSec, 1)).rjust(10)+" rollouts/sec, best score: "+str(bestScore)+", wall: "+str(round(wallSeconds, 2))+" s")
+
+
+def benchmarkLogProfiles(rolloutLimit=500, processCount=4):
+    # full per-rollout tracing through the logger process vs. the production profile
+    results = []
+    for profile in ["development", "production"]:
+        app = SyntheticPlanningApp()
+        planner = createPlanner(app, rolloutLimit, processCount, {"profile": profile}, silenceLog=False)
+        results.append((profile,) + runPlanner(planner, app))
+    print("\nLog profiles ("+str(processCount)+" processes x "+str(rolloutLimit)+" rollouts)")
+    for profile, rolloutsPerSec, bestScore, wallSeconds in results:
+        print("  "+profile.ljust(14)+str(round(rolloutsPerSec, 1)).rjust(10)+" rollouts/sec, best score: "+str(bestScore)+", wall: "+str(round(wallSeconds, 2))+" s")
+
+
+def benchmarkLogBackends(rolloutLimit=500, processCount=4, logDir="plannerLogs"):
+    # full tracing sent to the logger process vs. written to per-process log files
+    results = []
+    for backend in ["queue", "files"]:
+        app = SyntheticPlanningApp()
+        planner = createPlanner(app, rolloutLimit, processCount, {"logBackend": backend, "logDir": logDir}, silenceLog=False)
+        results.append((backend,) + runPlanner(planner, app))
+    print("\nLog backends ("+str(processCount)+" processes x "+str(rolloutLimit)+" rollouts)")
+    for backend, rolloutsPerSec, bestScore, wallSeconds in results:
+        print("  "+backend.ljust(14)+str(round(rolloutsPerSec, 1)).rjust(10)+" rollouts/sec, best score: "+str(bestScore)+", wall: "+str(round(wallSeconds, 2))+" s")
+
+
+def benchmarkTreeParallelScaling(maxProcessCount=8, timeLimit=5):
+    # one shared tree searched by 1..maxProcessCount workers for timeLimit seconds:
+    # global select/expand lock vs. tree-parallel search with virtual loss
+    results = []
+    for treeParallel in [False, True]:
+        for processCount in range(1, maxProcessCount + 1):
+            app = SyntheticPlanningApp()
+            planner = createPlanner(app, None, processCount, {"timeLimit": timeLimit, "treeParallel": treeParallel})
+            planner.useSharedNodes = True
+            results.append(("treeParallel" if treeParallel else "locked", processCount) + runPlanner(planner, app))
+    print("\nShared tree scaling ("+str(timeLimit)+" s per run)")
+    for mode, processCount, rolloutsPerSec, bestScore, wallSeconds in results:
+        print("  "+mode.ljust(14)+str(processCount).rjust(3)+" workers"+str(round(rolloutsPerSec, 1)).rjust(10)+" rollouts/sec, best score: "+str(bestScore))
+
+
+def benchmarkInProcess(rolloutLimit=20, repeats=5):
+    # startup cost of a small query: one worker behind the Manager/logger/Supervisor processes vs. inProcess mode
+    # (wall time includes creating the planner)
+    results = []
+    for inProcess in [False, True]:
+        wallSeconds = 0
+        for i in range(repeats):
+            startTime = time.time()
+            app = SyntheticPlanningApp()
+            planner = createPlanner(app, rolloutLimit, 1, {"inProcess": inProcess})
+            rolloutsPerSec, bestScore, _ = runPlanner(planner, app)
+            wallSeconds += time.time() - startTime
+        results.append(("inProcess" if inProcess else "processes", rolloutsPerSec, bestScore, wallSeconds / repeats))
+    print("\nSmall query startup (1 worker x "+str(rolloutLimit)+" rollouts, mean of "+str(repeats)+")")
+    for mode, rolloutsPerSec, bestScore, wallSeconds in results:
+        print("  "+mode.ljust(14)+str(round(rolloutsPerSec, 1)).rjust(10)+" rollouts/sec, best score: "+str(bestScore)+", wall: "+str(round(wallSeconds, 3))+" s")
+
+
+def benchmarkRootSync(rolloutLimit=300, processCount=4, repeats=3, syncInterval=25):
+    # independent trees vs. trees which share their root statistics every syncInterval rollouts:
+    # best score per CPU-second of search (summed over workers), mean of repeats runs
+    results = []
+    for rootSyncInterval in [0, syncInterval]:
+        bestScores = []
+        cpuSeconds = []
+        for i in range(repeats):
+            app = SyntheticPlanningApp(seed=11 + i)
+            planner = createPlanner(app, rolloutLimit, processCount, {"rootSyncInterval": rootSyncInterval})
+            _, bestScore, _ = runPlanner(planner, app)
+            bestScores.append(bestScore)
+            cpuSeconds.append(sum(treeResult["cpuSeconds"] for treeResult in planner.parallelResults))
+        meanScore = sum(bestScores) / repeats
+        meanCpu = sum(cpuSeconds) / repeats
+        results.append(("rootSync "+str(rootSyncInterval) if rootSyncInterval else "independent", meanScore, meanCpu))
+    print("\nRoot statistics sync ("+str(processCount)+" processes x "+str(rolloutLimit)+" rollouts, mean of "+str(repeats)+")")
+    for mode, meanScore, meanCpu in results:
+        print("  "+mode.ljust(14)+" best score: "+str(round(meanScore, 3))+", CPU: "+str(round(meanCpu, 2))+" s, score per CPU-second: "+str(round(meanScore / meanCpu, 2)))
+
+
+def main():
+    benchmarkSharedNodeBackends()
+    benchmarkLogProfiles()
+    benchmarkLogBackends()
+    benchmarkTreeParallelScaling()
+    benchmarkInProcess()
+    benchmarkRootSync()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from dshieldFireApp import DshieldFireApp
+
+DEFAULT_SOCKET_PATH = "/tmp/dshieldPlanner.sock"
+# app attributes built by createPlanVars() and initializePlanVars() which preparePlanVars() caches
+PLAN_VAR_ATTRS = ("allPlanVars", "initialPlanVars", "gpVars", "initialAgenda", "initialDomains", "varNames", "varSat", "varTick", "satIndexes", "gpIndexes", "gpIds", "gpValues", "cmdKinds", "cmdGps", "cmdParams")
+
+
+class PlannerDaemon:
+    # Long-running planner service: reads the input files (choices, target values, eclipses, power model)
+    # once, then serves plan requests over a local Unix domain socket, so each request costs only the search.
+    # Protocol: one JSON object per line. A request
+    #   {"type": "plan", "satellites": [...], "horizon": seconds, "rolloutLimit": n, "timeLimit": seconds,
+    #    "processCount": n, "storage": {...}, "window": seconds, "commit": seconds}
+    # (every field but "type" is optional) is answered by "progress" messages every progressInterval seconds
+    # and a final "plan" (or "error") message. {"type": "shutdown"} stops the daemon.
+
+    def __init__(self, app, socketPath=DEFAULT_SOCKET_PATH, progressInterval=1):
+        self.app = app
+        self.socketPath = socketPath
+        self.progressInterval = progressInterval
+        self.satList = list(app.satList) # satellites whose inputs are loaded
+        # request fields default to the app's settings at startup
+        self.defaults = {"horizon": app.planHorizonDuration, "rolloutLimit": app.planner.rolloutLimit,
+                         "timeLimit": app.planner.plannerTimeLimitSeconds, "processCount": app.planner.processCount,
+                         "storage": dict(app.storageParams), "window": app.planWindowDuration, "commit": app.planCommitDuration}
+        self.planVarsCache = {} # {(satellites, horizon, storage): (planVarAttrs values)}
+        self.searchError = None
+        self.requestCount = 0
+
+    def loadInputs(self):
+        startTime = time.time()
+        self.app.fileMgr.readInputs()
+        self.app.initPowerModel()
+        print("PlannerDaemon.loadInputs() satellites: "+str(self.satList)+", elapsed: "+str(round(time.time() - startTime, 3)))
+
+    def serve(self):
+        self.loadInputs()
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath) # left by a daemon which did not shut down
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketPath)
+        server.listen(1)
+        print("PlannerDaemon.serve() listening on "+self.socketPath)
+        done = False
+        try:
+            while not done:
+                # one client at a time: a search already uses every worker process
+                conn, _ = server.accept()
+                with conn, conn.makefile("rw") as stream:
+                    for line in stream:
+                        if not line.strip():
+                            continue
+                        done = self.handleMessage(json.loads(line), lambda msg: self.send(stream, msg))
+                        if done:
+                            break
+        finally:
+            server.close()
+            os.remove(self.socketPath)
+        print("PlannerDaemon.serve() exit")
+
+    def send(self, stream, msg):
+        stream.write(json.dumps(msg)+"\n")
+        stream.flush()
+
+    def handleMessage(self, msg, send):
+        # returns True when the daemon should stop
+        msgType = msg["type"] if "type" in msg else None
+        if msgType == "shutdown":
+            send({"type": "shutdown"})
+            return True
+        if msgType != "plan":
+            send({"type": "error", "message": "unknown message type: "+str(msgType)})
+            return False
+        try:
+            self.plan(msg, send)
+        except Exception as e:
+            # report a bad request or a failed search to the client and keep serving
+            send({"type": "error", "message": repr(e)})
+        return False
+
+    def plan(self, request, send):
+        self.requestCount += 1
+        startTime = time.time()
+        params = dict(self.defaults)
+        params.update((key, value) for key, value in request.items() if key in self.defaults)
+        satellites = request["satellites"] if "satellites" in request else self.satList
+        unknownSats = [sat for sat in satellites if sat not in self.satList]
+        if unknownSats:
+            raise ValueError("plan() ERROR! satellites not loaded by the daemon: "+str(unknownSats))
+        if not (params["rolloutLimit"] or params["timeLimit"]):
+            raise ValueError("plan() ERROR! request needs a rolloutLimit or a timeLimit")
+        self.configure(satellites, params)
+        if not self.app.planWindowDuration:
+            self.preparePlanVars()
+
+        # search in a thread, so progress can be sent while it runs
+        self.searchError = None
+        self.app.planner.sharedDict["bestPlanScore"] = 0 # progress of this request only
+        self.app.planner.sharedDict["bestPlanChoices"] = None
+        search = threading.Thread(target=self.search)
+        search.start()
+        while search.is_alive():
+            search.join(self.progressInterval)
+            if search.is_alive():
+                bestScore, _ = self.app.planner.getBestPlanSoFar()
+                send({"type": "progress", "elapsed": round(time.time() - startTime, 3), "bestScore": bestScore})
+        if self.searchError:
+            raise self.searchError
+
+        planner = self.app.planner
+        bestPlanState = planner.bestPlanState
+        plan = {sat: self.app.planText(bestPlanState[sat]["plan"], bestPlanState[sat]["images"]) for sat in satellites} if bestPlanState else None
+        send({"type": "plan", "request": self.requestCount, "score": planner.bestPlanScore, "plan": plan,
+              "rollouts": sum(treeResult["rollouts"] for treeResult in planner.parallelResults),
+              "seconds": round(time.time() - startTime, 3)})
+
+    def configure(self, satellites, params):
+        app = self.app
+        planner = app.planner
+        app.satList = list(satellites)
+        app.planHorizonDuration = params["horizon"]
+        app.storageParams = dict(self.defaults["storage"], **params["storage"])
+        app.planWindowDuration = params["window"]
+        app.planCommitDuration = params["commit"]
+        app.planVars = {} # vars left over from a failed search
+        planner.rolloutLimit = params["rolloutLimit"]
+        planner.plannerTimeLimitSeconds = params["timeLimit"]
+        if not planner.inProcess:
+            planner.processCount = params["processCount"]
+
+    def preparePlanVars(self):
+        # reuse the plan vars (and gpVars) of an earlier request with the same satellites, horizon and storage
+        app = self.app
+        key = (tuple(app.satList), app.planHorizonStart, app.planHorizonDuration, tuple(sorted(app.storageParams.items())))
+        if key in self.planVarsCache:
+            for attr, value in zip(PLAN_VAR_ATTRS, self.planVarsCache[key]):
+                setattr(app, attr, value)
+            return
+        app.createPlanVars()
+        # build gpVars once here, so forked workers inherit it instead of each building its own
+        app.initializeState()
+        app.initializePlanVars()
+        self.planVarsCache[key] = tuple(getattr(app, attr) for attr in PLAN_VAR_ATTRS)
+
+    def search(self):
+        app = self.app
+        try:
+            if app.planWindowDuration:
+                app.planRecedingHorizon()
+            else:
+                app.windowSnapshot = None
+                app.planner.initialTrees = None
+                app.planner.start(app.createConstellationPlan)
+        except Exception as e:
+            self.searchError = e
+
+
+def requestPlan(request, socketPath=DEFAULT_SOCKET_PATH):
+    # client: send one plan request and yield the daemon's replies (progress, then plan or error)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socketPath)
+        with client.makefile("rw") as stream:
+            stream.write(json.dumps(dict(request, type=request["type"] if "type" in request else "plan"))+"\n")
+            stream.flush()
+            for line in stream:
+                msg = json.loads(line)
+                yield msg
+                if msg["type"] != "progress":
+                    return
+
+
+def main():
+    # python plannerDaemon.py serve [socketPath]
+    # python plannerDaemon.py request '<json request>' [socketPath]
+    # python plannerDaemon.py shutdown [socketPath]
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "serve":
+        socketPath = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_SOCKET_PATH
+        PlannerDaemon(DshieldFireApp(), socketPath).serve()
+    elif command == "request":
+        socketPath = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_SOCKET_PATH
+        for msg in requestPlan(json.loads(sys.argv[2]), socketPath):
+            print(json.dumps(msg))
+    elif command == "shutdown":
+        socketPath = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_SOCKET_PATH
+        for msg in requestPlan({"type": "shutdown"}, socketPath):
+            print(json.dumps(msg))
+
+if __name__ == '__main__':
+    main()
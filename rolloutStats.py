@@ -0,0 +1,114 @@
+import math
+import struct
+import sys
+
+from array import array
+
+# (field name, array typecode) recorded for each rollout
+FIELDS = (
+    ("start",    "d"),  # seconds since the worker's search started
+    ("duration", "d"),  # seconds
+    ("depth",    "i"),  # tree depth of the rollout's last tree node
+    ("choices",  "i"),  # choice points with more than one choice
+    ("score",    "d"),
+)
+FILE_MAGIC = b"RSTATS01"
+
+
+class RolloutStats:
+    # Per-rollout statistics kept in numeric columns (one slot per rollout) instead of one
+    # formatted string per rollout. Columns are preallocated to the rollout limit when it is known.
+    # Binary file layout: magic, rollout count (int64), then each column's raw values in FIELDS order,
+    # all little-endian (columns are byte-swapped on big-endian hosts).
+
+    def __init__(self, capacity=0):
+        self.count = 0
+        for name, typecode in FIELDS:
+            setattr(self, name, array(typecode, bytes(array(typecode).itemsize * capacity)))
+
+    def record(self, start, duration, depth, choices, score):
+        i = self.count
+        if i < len(self.duration):
+            self.start[i] = start
+            self.duration[i] = duration
+            self.depth[i] = depth
+            self.choices[i] = choices
+            self.score[i] = score
+        else:
+            self.start.append(start)
+            self.duration.append(duration)
+            self.depth.append(depth)
+            self.choices.append(choices)
+            self.score.append(score)
+        self.count += 1
+
+    def trim(self):
+        # drop unused preallocated slots (before pickling or writing)
+        for name, _ in FIELDS:
+            column = getattr(self, name)
+            del column[self.count:]
+        return self
+
+    @staticmethod
+    def merge(statsList):
+        merged = RolloutStats()
+        for stats in statsList:
+            for name, _ in FIELDS:
+                getattr(merged, name).extend(getattr(stats, name)[:stats.count])
+            merged.count += stats.count
+        return merged
+
+    def summary(self, intervals=10):
+        # latency percentiles (ms) and rollouts/sec in each of `intervals` equal slices of the search
+        if not self.count:
+            return {"rollouts": 0}
+        durations = sorted(self.duration[:self.count])
+        result = {"rollouts": self.count}
+        for pct in (50, 95, 99):
+            result["p"+str(pct)+"ms"] = round(percentile(durations, pct) * 1000, 3)
+        result["maxMs"] = round(durations[-1] * 1000, 3)
+        result["meanDepth"] = round(sum(self.depth[:self.count]) / self.count, 2)
+        result["meanChoices"] = round(sum(self.choices[:self.count]) / self.count, 2)
+        result["rolloutsPerSec"] = self.throughput(intervals)
+        return result
+
+    def throughput(self, intervals):
+        # rollouts/sec by completion time; merged stats overlay all workers on one time axis
+        ends = [self.start[i] + self.duration[i] for i in range(self.count)]
+        span = max(ends)
+        if span <= 0:
+            return []
+        width = span / intervals
+        counts = [0] * intervals
+        for end in ends:
+            counts[min(int(end / width), intervals - 1)] += 1
+        return [round(count / width, 1) for count in counts]
+
+    def write(self, path):
+        with open(path, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write(struct.pack("<q", self.count))
+            for name, _ in FIELDS:
+                column = getattr(self, name)[:self.count]
+                if sys.byteorder == "big":
+                    column.byteswap()
+                column.tofile(f)
+
+    @staticmethod
+    def read(path):
+        stats = RolloutStats()
+        with open(path, "rb") as f:
+            assert f.read(len(FILE_MAGIC)) == FILE_MAGIC, "RolloutStats.read() ERROR! not a rollout stats file: "+path
+            stats.count = struct.unpack("<q", f.read(8))[0]
+            for name, _ in FIELDS:
+                column = getattr(stats, name)
+                column.fromfile(f, stats.count)
+                if sys.byteorder == "big":
+                    column.byteswap()
+        return stats
+
+
+def percentile(sortedValues, pct):
+    # nearest-rank percentile of an ascending list
+    rank = max(math.ceil(pct / 100 * len(sortedValues)), 1)
+    return sortedValues[rank - 1]
@@ -0,0 +1,167 @@
+from array import array
+from multiprocessing import shared_memory
+
+import multiprocessing as mp
+
+from mctsTree import MctsTree, COLUMNS, NULL_NODE
+
+
+class SharedMctsTree(MctsTree):
+    # MctsTree whose columns live in one multiprocessing.shared_memory block, so that
+    # parallel workers read and update the same tree in place (no Manager proxy, no pickling).
+    # Every node has a fixed-width slot in each column (column-major records) and the
+    # capacity is fixed when the block is created.
+    #   - node ids come from a counter in the block header, guarded by allocLock
+    #   - statistics and child links are guarded by striped per-node locks (nodeLock)
+    #   - move and name strings are only known to the process which created the node,
+    #     so replay uses the moveIndex column instead of interned moves
+
+    HEADER_BYTES = 8  # next node id
+
+    def __init__(self, capacity, lockCount=64):
+        self.capacity = capacity + 1  # +1 for the null node
+        size = self.HEADER_BYTES + sum(self.columnBytes(typecode) for _, typecode, _ in COLUMNS)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.allocLock = mp.Lock()
+        self.nodeLocks = [mp.Lock() for i in range(lockCount)]
+        self.attachColumns()
+        self.header[0] = 1  # slot 0 is the null node
+        for name, typecode, initialValue in COLUMNS:
+            getattr(self, name)[NULL_NODE] = initialValue
+        self.initLocalCaches()
+
+    def columnBytes(self, typecode):
+        # pad each column to 8 bytes so the next one stays aligned
+        nbytes = array(typecode).itemsize * self.capacity
+        return nbytes + (-nbytes % 8)
+
+    def attachColumns(self):
+        buf = self.shm.buf
+        self.header = buf[:self.HEADER_BYTES].cast("q")
+        offset = self.HEADER_BYTES
+        for name, typecode, _ in COLUMNS:
+            nbytes = array(typecode).itemsize * self.capacity
+            setattr(self, name, buf[offset:offset + nbytes].cast(typecode))
+            offset += self.columnBytes(typecode)
+
+    def initLocalCaches(self):
+        self.localMoves = {}  # {nodeId: move} for nodes created by this process (logging only)
+        self.localNames = {}  # {nodeId: varName}
+        self.planScores = {}
+        self.transpositions = None # per-process table, not supported for the shared tree
+        self.nodeHashes = {}
+        self.externalStats = {} # root statistics synchronization is for independent trees only
+
+    def __getstate__(self):
+        # memoryviews can't be pickled; reattach by name (spawn start method)
+        return {"capacity": self.capacity, "shmName": self.shm.name, "allocLock": self.allocLock, "nodeLocks": self.nodeLocks}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.shm = shared_memory.SharedMemory(name=state["shmName"])
+        self.allocLock = state["allocLock"]
+        self.nodeLocks = state["nodeLocks"]
+        self.attachColumns()
+        self.initLocalCaches()
+
+    def close(self):
+        # release the column views before closing the mapping
+        for name, _, _ in COLUMNS:
+            getattr(self, name).release()
+        self.header.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    # NODE CREATION
+
+    def newNodeId(self):
+        with self.allocLock:
+            nodeId = self.header[0]
+            assert nodeId < self.capacity, "SharedMctsTree.newNodeId() ERROR! node capacity reached: "+str(self.capacity - 1)
+            self.header[0] = nodeId + 1
+        for name, _, initialValue in COLUMNS:
+            getattr(self, name)[nodeId] = initialValue
+        return nodeId
+
+    def addChild(self, parentId, name, move, moveIndex):
+        childId = self.newNodeId()
+        self.parent[childId] = parentId
+        self.depth[childId] = self.depth[parentId] + 1
+        self.moveIndex[childId] = moveIndex
+        self.localMoves[childId] = move
+        self.localNames[childId] = name
+        with self.nodeLock(parentId):
+            self.linkChild(parentId, childId)
+        return childId
+
+    def nodeLock(self, nodeId):
+        return self.nodeLocks[nodeId % len(self.nodeLocks)]
+
+    # NODE ACCESS
+
+    def size(self):
+        return self.header[0]
+
+    def getPriorMove(self, nodeId):
+        return self.localMoves.get(nodeId)
+
+    def getName(self, nodeId):
+        return self.localNames.get(nodeId, "")
+
+    # CHOICES
+
+    def setChoices(self, nodeId, choiceCount):
+        with self.nodeLock(nodeId):
+            MctsTree.setChoices(self, nodeId, choiceCount)
+
+    def markExplored(self, nodeId, choiceIndex):
+        with self.nodeLock(nodeId):
+            MctsTree.markExplored(self, nodeId, choiceIndex)
+
+    # TREE-PARALLEL SEARCH
+
+    def selectLeafWithVirtualLoss(self, nodeId, virtualLoss=1):
+        # descend like MctsTree.selectLeaf() without any global lock, adding virtualLoss visits (with no reward)
+        # to each node on the way so that concurrent workers are steered towards other branches.
+        # returns (leaf id, path of node ids) - pass the path to removeVirtualLoss() before backpropagating
+        path = [nodeId]
+        self.addVisits(nodeId, virtualLoss)
+        while self.firstChild[nodeId] and not self.isLeaf(nodeId):
+            nodeId = self.bestChild(nodeId)
+            path.append(nodeId)
+            self.addVisits(nodeId, virtualLoss)
+        return nodeId, path
+
+    def removeVirtualLoss(self, path, virtualLoss=1):
+        for nodeId in path:
+            self.addVisits(nodeId, -virtualLoss)
+
+    def addVisits(self, nodeId, visits):
+        with self.nodeLock(nodeId):
+            self.visitCount[nodeId] += visits
+
+    def claimChoice(self, nodeId, choices, chooseFn):
+        # atomically pick one of the node's unexplored choices with chooseFn(unexploredChoices) and mark it explored,
+        # so two workers expanding the same leaf never create the same child. Returns None if none are left.
+        with self.nodeLock(nodeId):
+            unexplored = self.getUnexploredChoices(nodeId, choices)
+            if not unexplored:
+                return None
+            choice = chooseFn(unexplored)
+            MctsTree.markExplored(self, nodeId, choices.index(choice))
+            return choice
+
+    # STATISTICS
+
+    def backpropagate(self, nodeId, leafReward, reward):
+        with self.nodeLock(nodeId):
+            self.visitCount[nodeId] += 1
+            self.totalReward[nodeId] += leafReward
+        nodeId = self.parent[nodeId]
+        while nodeId:
+            with self.nodeLock(nodeId):
+                self.visitCount[nodeId] += 1
+                self.totalReward[nodeId] += reward
+            nodeId = self.parent[nodeId]
@@ -0,0 +1,62 @@
+import pickle
+
+from collections import OrderedDict
+
+
+class SnapshotCache:
+    # Bounded LRU cache of application-state snapshots keyed by tree node id.
+    # A snapshot is the application state right after the node's priorMove has been applied,
+    # so a rollout can restore the deepest cached ancestor of its selected leaf and replay only
+    # the moves below it. Snapshots are stored pickled: compact, and every restore gets a fresh copy.
+
+    def __init__(self, maxBytes, minVisits):
+        self.maxBytes = maxBytes
+        self.minVisits = minVisits # only snapshot nodes visited at least this often
+        self.snapshots = OrderedDict() # {nodeId: pickled snapshot}, least recently used first
+        self.bytesUsed = 0
+        self.peakBytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.replayStepsSkipped = 0
+
+    def offer(self, nodeId, visitCount, snapshotFn):
+        # cache the current application state for nodeId if the node is visited often enough
+        if visitCount < self.minVisits or nodeId in self.snapshots:
+            return
+        data = pickle.dumps(snapshotFn(), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxBytes:
+            return
+        self.snapshots[nodeId] = data
+        self.bytesUsed += len(data)
+        self.stores += 1
+        while self.bytesUsed > self.maxBytes:
+            _, evicted = self.snapshots.popitem(last=False)
+            self.bytesUsed -= len(evicted)
+            self.evictions += 1
+        self.peakBytes = max(self.peakBytes, self.bytesUsed)
+
+    def clear(self):
+        # drop every snapshot (node ids are renumbered when the tree is pruned)
+        self.snapshots.clear()
+        self.bytesUsed = 0
+
+    def findDeepest(self, replayPlan):
+        # replayPlan: [(moveIndex, nodeId), ...] deepest node first
+        # returns (position in replayPlan, snapshot) of the deepest cached node, or (None, None)
+        self.lookups += 1
+        for position, (_, nodeId) in enumerate(replayPlan):
+            data = self.snapshots.get(nodeId)
+            if data is not None:
+                self.snapshots.move_to_end(nodeId)
+                self.hits += 1
+                self.replayStepsSkipped += len(replayPlan) - position
+                return position, pickle.loads(data)
+        return None, None
+
+    def stats(self):
+        hitRate = round(self.hits / self.lookups, 3) if self.lookups else 0
+        return {"lookups": self.lookups, "hits": self.hits, "hitRate": hitRate, "entries": len(self.snapshots), "stores": self.stores,
+                "evictions": self.evictions, "replayStepsSkipped": self.replayStepsSkipped,
+                "memoryMB": round(self.bytesUsed / 1000000, 3), "peakMemoryMB": round(self.peakBytes / 1000000, 3)}
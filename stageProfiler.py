@@ -0,0 +1,45 @@
+# rollout stages in report order ("application" is time in application code between choice points,
+# "rootSync" is root statistics synchronization between rollouts)
+STAGES = ("select", "replay", "expand", "simulate", "application", "snapshot", "score", "backpropagate", "rootSync")
+
+
+class StageProfiler:
+    # Accumulated wall time (time.perf_counter) and call count per rollout stage of one worker.
+    # Cheap enough to leave on: one dict lookup and two additions per timed call.
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def stats(self):
+        # {stage: {"seconds": s, "calls": n, "pct": % of the profiled time}}
+        total = sum(self.seconds.values())
+        result = {}
+        for stage in self.seconds:
+            seconds = self.seconds[stage]
+            pct = round(100 * seconds / total, 1) if total else 0
+            result[stage] = {"seconds": round(seconds, 3), "calls": self.calls[stage], "pct": pct}
+        return result
+
+    @staticmethod
+    def merge(statsList):
+        # merge stats() of several workers
+        merged = StageProfiler()
+        for stats in statsList:
+            for stage, stageStats in stats.items():
+                merged.seconds[stage] = merged.seconds.get(stage, 0.0) + stageStats["seconds"]
+                merged.calls[stage] = merged.calls.get(stage, 0) + stageStats["calls"]
+        return merged.stats()
+
+
+def formatStageStats(stats):
+    # "select 1.2s (4.0%), replay ..." for stages with calls
+    parts = []
+    for stage, stageStats in stats.items():
+        if stageStats["calls"]:
+            parts.append(stage+" "+str(stageStats["seconds"])+"s ("+str(stageStats["pct"])+"%)")
+    return ", ".join(parts)
@@ -38,10 +38,11 @@ class Supervisor:
             if msgType == "start":
                 self.propel.parallelMCTS(self.propel.appMethod, self.propel.processCount)
                 self.logMsg("\n** Planning complete !! ** \n\nBest score: "+str(self.propel.bestPlanScore))
-                self.bestPlanState = self.propel.bestPlanState
-                self.sharedDict["bestPlanState"] = self.bestPlanState
+                self.sharedDict["bestPlanChoices"] = self.propel.bestPlanChoices
+                self.sharedDict["bestPlanScore"] = self.propel.bestPlanScore
                 done = True
         self.logMsg("SupervisorMsgHandler() exit")
+        self.propel.flushLog()
 
     def startTargetProc(self):
         targetMethod = getattr(self.propel.target, self.targetMethodName)
@@ -51,6 +52,12 @@ class Supervisor:
 
 
     def logMessage(self, msg):
+        if self.propel.logBackend == "files":
+            self.propel.getLogSink().write(msg) # per-process file, see LogSink
+            return
+        if self.propel.logBackend == "stdout":
+            print(msg)
+            return
         with self.logLock:
             self.loggerQ.put(msg)
 
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from itertools import islice
+
+
+class TranspositionTable:
+    # Bounded table of MCTS statistics shared by all tree nodes which reach the same application state
+    # (same state hash) through different move orders. Selection reads a node's visits and reward from
+    # its table entry, and backpropagation adds to both the node and the entry.
+    # When full, the least visited of the evictionSample least recently used entries is dropped;
+    # nodes whose entry was evicted fall back to their own statistics.
+
+    def __init__(self, maxEntries, evictionSample=8):
+        self.maxEntries = maxEntries
+        self.evictionSample = evictionSample
+        self.entries = OrderedDict() # {stateHash: [visitCount, totalReward]}, least recently used first
+        self.registrations = 0
+        self.transpositions = 0 # registrations of a state already reached by another node
+        self.evictions = 0
+
+    def register(self, stateHash):
+        # called once per node, when the node's state is first reached
+        self.registrations += 1
+        entry = self.entries.get(stateHash)
+        if entry is not None:
+            self.transpositions += 1
+            self.entries.move_to_end(stateHash)
+            return
+        self.entries[stateHash] = [0, 0.0]
+        if len(self.entries) > self.maxEntries:
+            self.evict()
+
+    def get(self, stateHash):
+        # (visitCount, totalReward) of the state, or None if it is not in the table
+        entry = self.entries.get(stateHash)
+        return entry if entry and entry[0] else None
+
+    def add(self, stateHash, reward):
+        entry = self.entries.get(stateHash)
+        if entry is not None:
+            entry[0] += 1
+            entry[1] += reward
+            self.entries.move_to_end(stateHash)
+
+    def evict(self):
+        candidates = islice(self.entries.items(), self.evictionSample)
+        stateHash = min(candidates, key=lambda item: item[1][0])[0]
+        del self.entries[stateHash]
+        self.evictions += 1
+
+    def stats(self):
+        hitRate = round(self.transpositions / self.registrations, 3) if self.registrations else 0
+        return {"entries": len(self.entries), "registrations": self.registrations, "transpositions": self.transpositions,
+                "hitRate": hitRate, "evictions": self.evictions}